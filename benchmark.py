@@ -0,0 +1,421 @@
+"""Benchmarks for the Ollama-like API for Venice.
+
+Micro-benchmarks of the streaming hot path run without a browser or
+Venice credentials:
+
+    python benchmark.py decoder --tokens 50000
+    python benchmark.py transfer --tokens 10000
+    python benchmark.py serialize --tokens 50000
+
+The load benchmark drives a running server, ideally one pointed at
+fake_venice.py, and prints its results as JSON:
+
+    python benchmark.py load --url http://127.0.0.1:9999 --concurrency 8 --requests 200
+
+The page benchmark starts Chrome to compare loading the chat page with
+and without resource blocking:
+
+    python benchmark.py page --repeat 5
+"""
+import argparse
+import array
+import base64
+import datetime
+import json
+import random
+import sys
+import time
+import timeit
+
+from ollama_like_server import BLOCKED_RESOURCE_PATTERNS, NDJSONDecoder, Generation, ResponseFormat, estimate_token_count, format_response
+from selenium.webdriver.support.ui import WebDriverWait
+import ollama_like_server
+from gevent.pool import Pool
+from prometheus_client.parser import text_string_to_metric_families
+import gevent
+import requests
+
+
+def venice_stream(tokens, max_chunk, seed=0):
+    """Synthetic Venice NDJSON response cut into chunks of random size."""
+    rng = random.Random(seed)
+    # Every tenth token has multi-byte characters, which chunks may split
+    body = b''.join(json.dumps({"kind": "content", "content": f" token{i}" if i % 10 else f" wörd🦙{i}"}, ensure_ascii=False).encode('utf-8') + b'\n'
+                    for i in range(tokens))
+    chunks = []
+    position = 0
+    while position < len(body):
+        size = rng.randint(1, max_chunk)
+        chunks.append(body[position:position + size])
+        position += size
+    return chunks
+
+
+def legacy_decode(chunks):
+    # String buffer with split('\n', 1), as the streaming loop used to do.
+    # It raised on characters split across chunks, replacing them keeps it
+    # running for the comparison.
+    objects = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8', 'replace')
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            if line:
+                objects.append(json.loads(line))
+    return objects
+
+
+def ndjson_decode(chunks):
+    objects = []
+    decoder = NDJSONDecoder()
+    for chunk in chunks:
+        objects.extend(decoder.feed(chunk))
+    objects.extend(decoder.close())
+    return objects
+
+
+def bench_decoder(args):
+    chunks = venice_stream(args.tokens, args.max_chunk)
+    print(f"{args.tokens} content lines in {len(chunks)} chunks of up to {args.max_chunk} bytes")
+    for name, decode in (("legacy string split", legacy_decode), ("NDJSONDecoder", ndjson_decode)):
+        best = min(timeit.repeat(lambda: decode(chunks), number=1, repeat=args.repeat))
+        print(f"{name:22} {best / len(chunks) * 1e6:8.2f} us/chunk {best * 1e3:10.1f} ms total")
+
+
+def bench_transfer(args):
+    # Each poll hands over what the browser received since the last one.
+    chunks = venice_stream(args.tokens, args.max_chunk)
+    polls = [chunks[i:i + args.chunks_per_poll] for i in range(0, len(chunks), args.chunks_per_poll)]
+
+    # WebDriver serializes Uint8Arrays as JSON arrays of integers.
+    int_array_payloads = [json.dumps({"chunks": [list(chunk) for chunk in poll], "complete": False}) for poll in polls]
+    base64_payloads = [json.dumps({"data": base64.b64encode(b''.join(poll)).decode('ascii'), "complete": False}) for poll in polls]
+
+    def receive_int_arrays():
+        for payload in int_array_payloads:
+            for chunk in json.loads(payload)['chunks']:
+                bytes(array.array('B', chunk))
+
+    def receive_base64():
+        for payload in base64_payloads:
+            base64.b64decode(json.loads(payload)['data'])
+
+    body_size = sum(len(chunk) for chunk in chunks)
+    print(f"{args.tokens} tokens, {body_size} bytes of NDJSON in {len(polls)} polls")
+    for name, payloads, receive in (("JSON integer arrays", int_array_payloads, receive_int_arrays), ("base64", base64_payloads, receive_base64)):
+        wire_size = sum(len(payload) for payload in payloads)
+        best = min(timeit.repeat(receive, number=1, repeat=args.repeat))
+        print(f"{name:22} {wire_size:10} bytes over WebDriver ({wire_size / body_size:.2f}x) {best * 1e3:8.1f} ms CPU")
+
+
+def legacy_format(pieces, response_format, model_id):
+    # A dict, a datetime and json.dumps per piece, and string concatenation,
+    # as format_response used to do. The tokens are estimated the same way
+    # in both, so the difference is the serialization.
+    streamed_content = ""
+    for index, content in enumerate(pieces):
+        streamed_content += content
+        if response_format == ResponseFormat.CHAT:
+            message = {
+                "model": model_id,
+                "created_at": datetime.datetime.utcnow().isoformat() + "Z",
+                "message": {"role": "assistant", "content": content},
+                "done": False
+            }
+            yield f"{json.dumps(message)}\r\n"
+        elif response_format == ResponseFormat.OPENAI_STREAM:
+            delta = {"role": "assistant", "content": content} if index == 0 else {"content": content}
+            event = {"id": "chatcmpl-0", "object": "chat.completion.chunk", "created": 0, "model": model_id, "system_fingerprint": "fp_ollama",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            yield f"data: {json.dumps(event)}\n\n"
+    yield json.dumps({"model": model_id, "message": {"role": "assistant", "content": streamed_content}, "done": True,
+                      "eval_count": estimate_token_count(streamed_content)})
+
+
+def current_format(pieces, response_format, model_id):
+    generation = Generation({"model": model_id, "messages": [{"role": "user", "content": "Benchmark"}]})
+    return format_response((piece for piece in pieces), generation, response_format)
+
+
+def bench_serialize(args):
+    # CPU per content piece of turning a long response into what the client
+    # receives, before and after the templates, with and without orjson.
+    pieces = [f" token{i}" if i % 10 else f" \"quoted\" wörd\n{i}" for i in range(args.tokens)]
+    formats = (("chat", ResponseFormat.CHAT), ("chat-sync", ResponseFormat.CHAT_NON_STREAMED),
+               ("openai", ResponseFormat.OPENAI_NON_STREAMED), ("openai-stream", ResponseFormat.OPENAI_STREAM))
+    variants = [("legacy", legacy_format, None), ("templates", current_format, None)]
+    if ollama_like_server.orjson is not None:
+        variants.append(("templates+orjson", current_format, ollama_like_server.orjson))
+    print(f"{args.tokens} content pieces per response")
+    installed_orjson = ollama_like_server.orjson
+    try:
+        for format_name, response_format in formats:
+            for variant_name, serialize, backend in variants:
+                ollama_like_server.orjson = backend
+
+                def run():
+                    start = time.process_time()
+                    for _ in serialize(pieces, response_format, "llama-3.3-70b"):
+                        pass
+                    return time.process_time() - start
+
+                best = min(run() for _ in range(args.repeat))
+                print(f"{format_name:14} {variant_name:17} {best / args.tokens * 1e6:8.2f} us/piece {best * 1e3:10.1f} ms CPU")
+    finally:
+        ollama_like_server.orjson = installed_orjson
+
+
+# Workload name: (path, stream, how the response is framed)
+WORKLOADS = {
+    "chat": ("/api/chat", True, "ndjson"),
+    "chat-sync": ("/api/chat", False, "json"),
+    "generate": ("/api/generate", True, "ndjson"),
+    "openai": ("/v1/chat/completions", False, "json"),
+    "openai-stream": ("/v1/chat/completions", True, "sse")
+}
+
+
+def workload_body(workload, model, prompt, max_tokens):
+    # The server ends the response at the limit, so its size varies even
+    # against fake_venice.py, which ignores the prompt
+    path, stream, framing = WORKLOADS[workload]
+    if path == "/api/generate":
+        return {"model": model, "prompt": prompt, "stream": stream, "options": {"num_predict": max_tokens}}
+    body = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": stream}
+    if path == "/v1/chat/completions":
+        body["max_tokens"] = max_tokens
+    else:
+        body["options"] = {"num_predict": max_tokens}
+    return body
+
+
+def is_content_line(framing, line):
+    if framing == "json":
+        return True
+    if framing == "sse":
+        if not line.startswith(b"data: ") or line == b"data: [DONE]":
+            return False
+        choices = json.loads(line[len(b"data: "):])["choices"]
+        return bool(choices and choices[0]["delta"].get("content"))
+    message = json.loads(line)
+    return not message.get("done") and bool(message.get("response") or message.get("message", {}).get("content"))
+
+
+def run_request(http, url, workload, body, timeout):
+    path, stream, framing = WORKLOADS[workload]
+    start = time.perf_counter()
+    content_times = []
+    try:
+        with http.post(url + path, json=body, stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                return {"workload": workload, "error": f"HTTP {response.status_code}"}
+            for line in response.iter_lines(chunk_size=None):
+                if line and is_content_line(framing, line):
+                    content_times.append(time.perf_counter())
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return {"workload": workload, "error": type(e).__name__}
+    return {"workload": workload, "start": start, "end": time.perf_counter(), "content_times": content_times}
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {
+        "p50": round(rank(50) * 1e3, 2),
+        "p95": round(rank(95) * 1e3, 2),
+        "p99": round(rank(99) * 1e3, 2),
+        "mean": round(sum(values) / len(values) * 1e3, 2),
+        "max": round(values[-1] * 1e3, 2)
+    }
+
+
+def summarize(results, elapsed):
+    completed = [result for result in results if "error" not in result]
+    errors = {}
+    for result in results:
+        if "error" in result:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    streamed = [result for result in completed if WORKLOADS[result["workload"]][1] and result["content_times"]]
+    inter_token = [later - earlier for result in streamed for earlier, later in zip(result["content_times"], result["content_times"][1:])]
+    content_lines = sum(len(result["content_times"]) for result in streamed)
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "throughput_rps": round(len(completed) / elapsed, 3),
+        "streamed_chunks_per_second": round(content_lines / elapsed, 3),
+        "ttft_ms": percentiles([result["content_times"][0] - result["start"] for result in streamed]),
+        "inter_token_ms": percentiles(inter_token),
+        "latency_ms": percentiles([result["end"] - result["start"] for result in completed])
+    }
+
+
+def server_process_metrics(http, url):
+    # prometheus_client exports the server's own CPU time and RSS on Linux
+    try:
+        text = http.get(url + "/metrics", timeout=5).text
+    except requests.exceptions.RequestException:
+        return {}
+    values = {}
+    for family in text_string_to_metric_families(text):
+        if family.name in ("process_cpu_seconds", "process_resident_memory_bytes"):
+            values[family.name] = family.samples[0].value
+    return values
+
+
+def bench_load(args):
+    workloads = {}
+    for option in args.mix.split(","):
+        name, _, weight = option.partition("=")
+        if name not in WORKLOADS:
+            sys.exit(f"Unknown workload {name}, choose from {', '.join(WORKLOADS)}")
+        workloads[name] = float(weight or 1)
+    prompt_words = [int(words) for words in args.prompt_words.split(",")]
+    response_tokens = [int(tokens) for tokens in args.response_tokens.split(",")]
+
+    http = requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    url = args.url.rstrip("/")
+    # The server rejects models missing from the list it loaded from Venice
+    model = args.model or http.get(f"{url}/api/tags", timeout=args.timeout).json()["models"][0]["name"]
+
+    # Every prompt is unique so the response cache and coalescing stay out of the measurement
+    rng = random.Random(args.seed)
+    requests_to_send = []
+    for i in range(args.requests):
+        workload = rng.choices(list(workloads), weights=list(workloads.values()))[0]
+        words = rng.choice(prompt_words)
+        tokens = rng.choice(response_tokens)
+        prompt = f"Request {i}: answer in about {tokens} words. " + " ".join(f"word{rng.randrange(10000)}" for _ in range(words))
+        requests_to_send.append((workload, workload_body(workload, model, prompt, tokens)))
+
+    peak_rss = [0]
+    def sample_rss():
+        while True:
+            peak_rss[0] = max(peak_rss[0], server_process_metrics(http, url).get("process_resident_memory_bytes", 0))
+            gevent.sleep(args.sample_interval)
+
+    before = server_process_metrics(http, url)
+    sampler = gevent.spawn(sample_rss)
+    pool = Pool(args.concurrency)
+    start = time.perf_counter()
+    results = pool.map(lambda item: run_request(http, url, item[0], item[1], args.timeout), requests_to_send)
+    elapsed = time.perf_counter() - start
+    sampler.kill()
+    after = server_process_metrics(http, url)
+
+    report = {
+        "config": {name: value for name, value in vars(args).items() if name != "run"},
+        "elapsed_seconds": round(elapsed, 3),
+        "total": summarize(results, elapsed),
+        "workloads": {workload: summarize([result for result in results if result["workload"] == workload], elapsed) for workload in workloads},
+        "server": {
+            "cpu_seconds": round(after["process_cpu_seconds"] - before["process_cpu_seconds"], 3) if "process_cpu_seconds" in before and "process_cpu_seconds" in after else None,
+            "rss_bytes_peak": int(max(peak_rss[0], after.get("process_resident_memory_bytes", 0))) or None
+        }
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+PAGE_TIMING_SCRIPT = """
+const navigation = performance.getEntriesByType('navigation')[0];
+const resources = performance.getEntriesByType('resource');
+return {
+    domContentLoaded: navigation.domContentLoadedEventEnd / 1000,
+    load: navigation.loadEventEnd / 1000,
+    resources: resources.length,
+    transferBytes: navigation.transferSize + resources.reduce((total, resource) => total + resource.transferSize, 0)
+};
+"""
+
+
+def load_page(url, blocked_urls, args):
+    driver = ollama_like_server.get_webdriver(headless=True, docker=args.docker, blocked_urls=blocked_urls)
+    try:
+        driver.execute_cdp_cmd('Performance.enable', {})
+        driver.get(url)
+        WebDriverWait(driver, 60).until(lambda d: d.execute_script("return document.readyState") == 'complete')
+        # Let the single-page app settle before sampling its memory
+        time.sleep(args.settle)
+        timing = driver.execute_script(PAGE_TIMING_SCRIPT)
+        metrics = {metric['name']: metric['value'] for metric in driver.execute_cdp_cmd('Performance.getMetrics', {})['metrics']}
+        # Includes the renderer, GPU and network processes the JS heap leaves out
+        rss = ollama_like_server.browser_rss(driver)
+    finally:
+        driver.quit()
+    return {
+        "dom_content_loaded_seconds": timing['domContentLoaded'],
+        "load_seconds": timing['load'],
+        "resources": timing['resources'],
+        "transfer_bytes": timing['transferBytes'],
+        "js_heap_bytes": metrics.get('JSHeapUsedSize', 0),
+        "dom_nodes": metrics.get('Nodes', 0),
+        "browser_rss_bytes": rss
+    }
+
+
+def bench_page(args):
+    # get_webdriver reads the server's command line for the seed login
+    ollama_like_server.args = args
+    blocked_urls = BLOCKED_RESOURCE_PATTERNS + args.block_url
+    report = {"url": args.url}
+    for name, patterns in (("unblocked", None), ("blocked", blocked_urls)):
+        runs = [load_page(args.url, patterns, args) for _ in range(args.repeat)]
+        # browser_rss_bytes is None where the process tree cannot be read
+        report[name] = {key: round(sum(run[key] for run in runs) / len(runs), 3) if runs[0][key] is not None else None
+                        for key in runs[0]}
+    print(json.dumps(report, indent=2))
+
+
+parser = argparse.ArgumentParser(description='Benchmarks for the Ollama-like API for venice.ai')
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+decoder_parser = subparsers.add_parser('decoder', help='NDJSON line reassembly cost per received chunk')
+decoder_parser.add_argument('--tokens', type=int, default=50000, help='Number of content lines in the response')
+decoder_parser.add_argument('--max-chunk', type=int, default=2048, help='Maximum chunk size in bytes')
+decoder_parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported')
+decoder_parser.set_defaults(run=bench_decoder)
+
+transfer_parser = subparsers.add_parser('transfer', help='Size and decoding cost of chunks handed over by the browser')
+transfer_parser.add_argument('--tokens', type=int, default=10000, help='Number of content lines in the response')
+transfer_parser.add_argument('--max-chunk', type=int, default=256, help='Maximum size in bytes of a chunk read by the browser')
+transfer_parser.add_argument('--chunks-per-poll', type=int, default=1, help='Chunks collected by each poll')
+transfer_parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported')
+transfer_parser.set_defaults(run=bench_transfer)
+
+serialize_parser = subparsers.add_parser('serialize', help='CPU per content piece of formatting long responses')
+serialize_parser.add_argument('--tokens', type=int, default=50000, help='Number of content pieces in the response')
+serialize_parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs, the best one is reported')
+serialize_parser.set_defaults(run=bench_serialize)
+
+load_parser = subparsers.add_parser('load', help='Concurrent requests against a running server, results as JSON')
+load_parser.add_argument('--url', type=str, default='http://127.0.0.1:9999', help='Base URL of the server')
+load_parser.add_argument('--model', type=str, default=None, help='Model to request, defaults to the first one the server lists')
+load_parser.add_argument('--mix', type=str, default='chat=1,chat-sync=1,generate=1,openai=1,openai-stream=1', help=f"Workloads and their weights, from: {', '.join(WORKLOADS)}")
+load_parser.add_argument('--concurrency', type=int, default=4, help='Requests in flight at the same time')
+load_parser.add_argument('--requests', type=int, default=100, help='Total number of requests')
+load_parser.add_argument('--prompt-words', type=str, default='10,100,1000', help='Prompt sizes in words, one is picked per request')
+load_parser.add_argument('--response-tokens', type=str, default='50,200,400', help='Response lengths in tokens, one is picked per request and sent as num_predict or max_tokens')
+load_parser.add_argument('--timeout', type=int, default=300, help='Seconds to wait for a response')
+load_parser.add_argument('--sample-interval', type=float, default=0.5, help='Seconds between samples of the server RSS')
+load_parser.add_argument('--seed', type=int, default=0, help='Seed for the workload and prompt choice')
+load_parser.add_argument('--output', type=str, default=None, help='Also write the JSON results to this file')
+load_parser.set_defaults(run=bench_load)
+
+page_parser = subparsers.add_parser('page', help='Chat page load time and renderer memory with and without resource blocking')
+page_parser.add_argument('--url', type=str, default='https://venice.ai/chat', help='Page to load')
+page_parser.add_argument('--block-url', action='append', default=[], metavar='PATTERN', help='Additional URL pattern to block, can be repeated')
+page_parser.add_argument('--repeat', type=int, default=3, help='Page loads per variant, the mean is reported')
+page_parser.add_argument('--settle', type=float, default=2.0, help='Seconds to wait after the load event before sampling memory')
+page_parser.add_argument('--docker', action='store_true', default=False, help='Do not run Chrome sandbox (required for docker)')
+page_parser.set_defaults(run=bench_page, seed=None)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.run(args)
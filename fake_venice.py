@@ -0,0 +1,198 @@
+"""Local stand-in for venice.ai, for benchmarks and tests without network.
+
+It serves a sign-in page and a minimal chat page with the elements
+ollama_like_server.py waits for, and answers /api/inference/chat by
+replaying streams saved with ollama_like_server.py --record-dir, keeping
+their timing. Without recordings it streams synthetic tokens.
+
+    python fake_venice.py --port 8080 --recordings recordings/
+    python ollama_like_server.py --venice-url http://127.0.0.1:8080 --username test --password test
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, request, Response, redirect
+from gevent.pywsgi import WSGIServer
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import os
+import time
+
+app = Flask(__name__)
+
+SESSION_COOKIE = 'fake_venice_session'
+
+SIGN_IN_PAGE = """<!doctype html>
+<html>
+<head><title>Sign in - Fake Venice</title></head>
+<body>
+<form id="sign-in" onsubmit="return signIn()">
+  <input id="identifier" type="email" placeholder="Email">
+  <div id="password-step" style="display: none">
+    <input id="password" type="password" placeholder="Password">
+  </div>
+  <button type="submit">Sign in</button>
+</form>
+<script>
+function signIn() {
+  const passwordStep = document.getElementById('password-step');
+  if (passwordStep.style.display === 'none') {
+    passwordStep.style.display = 'block';
+  } else {
+    document.cookie = '""" + SESSION_COOKIE + """=' + crypto.randomUUID() + '; path=/; max-age=31536000';
+    window.location = '/chat';
+  }
+  return false;
+}
+</script>
+</body>
+</html>
+"""
+
+CHAT_PAGE = """<!doctype html>
+<html>
+<head><title>Fake Venice</title></head>
+<body>
+<button type="button"><span>PRO</span></button>
+<button type="button" onclick="showComposer()"><p>Text Conversation</p></button>
+<form id="composer" style="display: none" onsubmit="return ask()">
+  <textarea placeholder="Ask a question"></textarea>
+  <button type="submit" aria-label="submit">Send</button>
+</form>
+<div id="answer"></div>
+<script>
+function showComposer() {
+  document.getElementById('composer').style.display = 'block';
+}
+
+// Like Venice, the first question on /chat opens a new conversation
+function ask() {
+  if (window.location.pathname === '/chat') {
+    window.location = '/chat/' + crypto.randomUUID();
+    return false;
+  }
+  const answer = document.getElementById('answer');
+  answer.textContent = '';
+  fetch('/api/inference/chat', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({
+      requestId: crypto.randomUUID().slice(0, 8),
+      modelId: 'llama-3.1-405b-akash-api',
+      prompt: [{role: 'user', content: document.querySelector('textarea').value}],
+      systemPrompt: '',
+      conversationType: 'text'
+    })
+  }).then(async response => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      answer.textContent += decoder.decode(value, {stream: true});
+    }
+  }).catch(error => console.error('Fake Venice request failed:', error));
+  return false;
+}
+
+if (window.location.pathname !== '/chat') showComposer();
+</script>
+</body>
+</html>
+"""
+
+
+def recording_key(model_id, prompt):
+    return hashlib.sha256(json.dumps([model_id, prompt], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Recordings:
+    """Streams saved by ollama_like_server.py --record-dir. A request is
+    answered with a recording of the same model and prompt when there is
+    one, otherwise the recordings take turns.
+    """
+
+    def __init__(self, directory):
+        self.by_key = {}
+        self.all = []
+        self.model_ids = set()
+        if directory:
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.json'):
+                    continue
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    recording = json.load(f)
+                chunks = [(chunk['delay'], base64.b64decode(chunk['data'])) for chunk in recording['chunks']]
+                self.by_key.setdefault(recording_key(recording['modelId'], recording['prompt']), []).append(chunks)
+                self.all.append(chunks)
+                self.model_ids.add(recording['modelId'])
+        self.turns = itertools.cycle(self.all)
+
+    def find(self, api_data):
+        matching = self.by_key.get(recording_key(api_data.get('modelId'), api_data.get('prompt')))
+        if matching:
+            return matching[0]
+        if self.all:
+            return next(self.turns)
+        return None
+
+
+def synthetic_chunks(tokens, token_delay):
+    for i in range(tokens):
+        yield token_delay, (json.dumps({"kind": "content", "content": f" token{i}"}) + "\n").encode('utf-8')
+
+
+def replay(chunks, speed):
+    for delay, data in chunks:
+        if speed > 0 and delay > 0:
+            time.sleep(delay / speed)
+        yield data
+
+
+@app.route('/sign-in', methods=['GET'])
+def sign_in():
+    return Response(SIGN_IN_PAGE, content_type='text/html')
+
+@app.route('/chat', methods=['GET'])
+@app.route('/chat/<conversation_id>', methods=['GET'])
+def chat(conversation_id=None):
+    if SESSION_COOKIE not in request.cookies:
+        return redirect('/sign-in')
+    return Response(CHAT_PAGE, content_type='text/html')
+
+@app.route('/api/v1/models', methods=['GET'])
+def models():
+    model_ids = sorted({'llama-3.1-405b-akash-api'} | recordings.model_ids)
+    return Response(json.dumps({"data": [{"id": model_id, "type": "text"} for model_id in model_ids]}), content_type='application/json')
+
+@app.route('/api/inference/chat', methods=['POST'])
+def inference_chat():
+    if SESSION_COOKIE not in request.cookies:
+        return Response("Unauthorized", status=401, content_type='text/plain')
+    api_data = request.get_json(force=True)
+    chunks = recordings.find(api_data)
+    if chunks is None:
+        chunks = synthetic_chunks(args.tokens, args.token_delay)
+    return Response(replay(chunks, args.speed), content_type='application/x-ndjson')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for venice.ai that replays recorded streams')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Local host address')
+    parser.add_argument('--port', type=int, default=8080, help='Server port')
+    parser.add_argument('--recordings', type=str, default=None, help='Directory with streams saved by ollama_like_server.py --record-dir')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the recorded timing, 0 replays without delays')
+    parser.add_argument('--tokens', type=int, default=200, help='Tokens per synthetic response, used when there are no recordings')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Seconds between synthetic tokens')
+
+    args = parser.parse_args()
+    recordings = Recordings(args.recordings)
+    print(f"Replaying {len(recordings.all)} recordings" if recordings.all else f"No recordings, streaming {args.tokens} synthetic tokens per response")
+
+    print(f"Starting fake Venice at {args.host}:{args.port}")
+    http_server = WSGIServer((args.host, args.port), app)
+    http_server.serve_forever()
@@ -1,3 +1,6 @@
+from gevent import monkey
+monkey.patch_all()
+
 from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -9,28 +12,56 @@ from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.common.keys import Keys
 from selenium.common.exceptions import ElementClickInterceptedException, TimeoutException, WebDriverException
 from flask import Flask, request, Response
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+import requests
 import json
 import uuid
-from datetime import datetime, timezone
 from gevent.pywsgi import WSGIServer
 from gevent.lock import Semaphore
+from gevent.event import AsyncResult, Event
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+import gevent
+import gevent.queue
 import time
 import argparse
 import os
 import sys
 import hashlib
+import math
+import re
 from enum import Enum
-import array
+import base64
+import copy
+from json.encoder import encode_basestring_ascii
+
+# Optional, serializes whole messages several times faster than json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
-selenium_lock = Semaphore()
-driver = {}
+server_ready = Event()
+
+STAGE_SECONDS = Histogram('venice_stage_seconds', 'Time spent in each stage of serving a request', ['stage'],
+                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+REQUESTS = Counter('venice_requests_total', 'Requests by route, model and response format', ['route', 'model', 'format'])
+TIMEOUTS = Counter('venice_timeouts_total', 'Generations stopped because Venice sent no data for --timeout seconds')
+RELOGINS = Counter('venice_relogins_total', 'Browser sessions replaced after a WebDriverException or rejected credentials')
+JSON_PARSE_FAILURES = Counter('venice_json_parse_failures_total', 'Lines of the Venice stream that were not valid JSON')
+COALESCED = Counter('venice_coalesced_requests_total', 'Requests that joined an identical generation already in flight')
+RECYCLES = Counter('venice_session_recycles_total', 'Tabs reloaded and sessions replaced by the watchdog, by reason', ['reason'])
+CACHE_LOOKUPS = Counter('venice_cache_lookups_total', 'Response cache lookups by result', ['result'])
+ACCOUNT_COOLDOWNS = Counter('venice_account_cooldowns_total', 'Times an account was taken out of rotation, by reason', ['account', 'reason'])
 
 class ResponseFormat(Enum):
     CHAT = 1
     GENERATE = 2
-    COMPLETION_AS_STRING = 3
+    OPENAI_NON_STREAMED = 3
     CHAT_NON_STREAMED = 4
+    OPENAI_STREAM = 5
 
 
 def capture_and_redirect_browser_logs(driver):
@@ -41,7 +72,25 @@ def capture_and_redirect_browser_logs(driver):
         print(f"Browser log: {entry['level']} - {entry['message']}", file=sys.stderr)
 
 
-def get_webdriver(headless=True, debug_browser=False, docker=False):
+# Resources the chat tab never needs: it is only used to log in and as the
+# origin of the requests to Venice. Patterns use the wildcards of the
+# DevTools Network.setBlockedURLs command.
+BLOCKED_RESOURCE_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf",
+    "*.mp3", "*.mp4", "*.webm",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*plausible.io*", "*posthog.com*", "*segment.io*", "*sentry.io*", "*hotjar.com*", "*intercom.io*"
+]
+
+def get_webdriver(headless=True, debug_browser=False, docker=False, profile_dir=None, blocked_urls=None):
+    driver = start_webdriver(headless, debug_browser, docker, profile_dir)
+    if blocked_urls:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked_urls})
+    return driver
+
+def start_webdriver(headless, debug_browser, docker, profile_dir):
     chrome_options = webdriver.ChromeOptions()
     if headless:
         chrome_options.add_argument("--headless")
@@ -54,6 +103,9 @@ def get_webdriver(headless=True, debug_browser=False, docker=False):
     if args.seed:
         chrome_options.add_argument("--disable-features=ChromeAppsDeprecation")
 
+    if profile_dir:
+        chrome_options.add_argument(f"--user-data-dir={os.path.abspath(profile_dir)}")
+
     chrome_options.page_load_strategy = 'eager'
     # Check if system-wide chromedriver exists
     system_chromedriver = "/usr/bin/chromedriver"
@@ -96,8 +148,7 @@ def get_webdriver(headless=True, debug_browser=False, docker=False):
 
     raise Exception("Neither Chrome nor Chromium could be initialized. Please make sure one of them is installed.")
 
-def ensure_logged_in(driver):
-    max_attempts = 3
+def ensure_logged_in(driver, max_attempts=3):
     attempt = 0
 
     # Wait for the account button to contain the "PRO" span (to make sure
@@ -124,12 +175,12 @@ def ensure_logged_in(driver):
     if attempt == max_attempts:
         raise TimeoutException("PRO span not found after maximum refresh attempts")
 
-def login_to_venice_with_username(username, password):
-    global driver, args
+def login_to_venice_with_username(username, password, profile_dir=None):
+    global args
     print(f"Logging in to venice with username and password...")
-    driver = get_webdriver(headless=args.headless, debug_browser=args.debug_browser, docker=args.docker)
+    driver = get_webdriver(headless=args.headless, debug_browser=args.debug_browser, docker=args.docker, profile_dir=profile_dir, blocked_urls=blocked_urls)
 
-    driver.get("https://venice.ai/sign-in")
+    driver.get(f"{venice_url}/sign-in")
     wait = WebDriverWait(driver, selenium_timeout)
 
     email_field = wait.until(EC.visibility_of_element_located((By.ID, "identifier")))
@@ -398,14 +449,14 @@ def element_and_shadow_root_exist(driver, selector):
     """
     return driver.execute_script(script)
 
-def login_to_venice_with_seed(seed):
-    global driver, args
+def login_to_venice_with_seed(seed, profile_dir=None):
+    global args
     print(f"Logging in to venice with seed...")
-    driver = get_webdriver(headless=args.headless, debug_browser=args.debug_browser, docker=args.docker)
+    driver = get_webdriver(headless=args.headless, debug_browser=args.debug_browser, docker=args.docker, profile_dir=profile_dir, blocked_urls=blocked_urls)
 
     driver.get("about:blank")
     inject_web3_provider(driver, seed)
-    driver.get("https://venice.ai/sign-in")
+    driver.get(f"{venice_url}/sign-in")
     print("Injecting web3 provider")
     inject_web3_provider(driver, seed)
 
@@ -474,72 +525,997 @@ def login_to_venice_with_seed(seed):
     return driver
 
 
-def login_to_venice():
-    if (username is not None and password is not None and len(username)>0):
-        return login_to_venice_with_username(username, password)
-    elif (seed is not None):
-        return login_to_venice_with_seed(seed)
+def restore_venice_session(profile_dir):
+    # A browser profile saved by an earlier run is often still logged in,
+    # which skips the whole sign-in flow.
+    if not os.path.isdir(profile_dir) or not os.listdir(profile_dir):
+        return None
+    print(f"Restoring Venice session from {profile_dir}")
+    driver = get_webdriver(headless=args.headless, debug_browser=args.debug_browser, docker=args.docker, profile_dir=profile_dir, blocked_urls=blocked_urls)
+    try:
+        driver.get(f"{venice_url}/chat")
+        ensure_logged_in(driver, max_attempts=1)
+    except WebDriverException as e:
+        print(f"Saved session in {profile_dir} is not logged in anymore ({e.msg}), logging in again")
+        driver.quit()
+        return None
+    print(f"Restored Venice session from {profile_dir}")
+    return driver
+
+def login_to_venice(profile_dir=None, account=None):
+    if profile_dir:
+        driver = restore_venice_session(profile_dir)
+        if driver:
+            return driver
+
+    if account is not None:
+        login_username, login_password, login_seed = account.username, account.password, account.seed
+    else:
+        login_username, login_password, login_seed = username, password, seed
+    if (login_username is not None and login_password is not None and len(login_username)>0):
+        return login_to_venice_with_username(login_username, login_password, profile_dir)
+    elif (login_seed is not None):
+        return login_to_venice_with_seed(login_seed, profile_dir)
     else:
         print("No username and password, nor seed provided")
         sys.exit(1)
 
-def inject_request_interceptor(driver, api_data_json):
-    script = f"""
+
+class Account:
+    """One Venice account and a token bucket model of its rate limits.
+
+    The bucket holds up to `burst` requests and refills at
+    requests_per_minute, 0 meaning unlimited. An account that Venice
+    throttles, or that returns error_threshold errors in a row, cools down:
+    it gets no requests for `cooldown` seconds, doubled each time it cools
+    down again before a generation completes, up to max_cooldown.
+    """
+
+    error_threshold = 3
+
+    def __init__(self, name, username=None, password=None, seed=None, sessions=1,
+                 requests_per_minute=0, burst=0, cooldown=60, max_cooldown=900):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.seed = seed
+        self.sessions = sessions
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst or max(1, requests_per_minute)
+        self.tokens = self.burst
+        self.refilled_at = time.time()
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooling_until = 0
+        self.last_throttled = None
+        self.errors = 0
+        self.active = 0
+        self.requests = 0
+        self.times_throttled = 0
+
+    def _refill(self, now):
+        if self.requests_per_minute:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.requests_per_minute / 60)
+        self.refilled_at = now
+
+    def wait_time(self):
+        # Seconds until the account may take another request
+        now = time.time()
+        wait = max(0, self.cooling_until - now)
+        if self.requests_per_minute:
+            self._refill(now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) * 60 / self.requests_per_minute)
+        return wait
+
+    def ready(self):
+        return self.wait_time() == 0
+
+    def take(self):
+        self.requests += 1
+        if self.requests_per_minute:
+            self._refill(time.time())
+            self.tokens -= 1
+
+    def record_generation(self, generation):
+        if generation.throttled:
+            self.times_throttled += 1
+            self.last_throttled = time.time()
+            # Venice allows less than the bucket assumed
+            self.tokens = min(self.tokens, 0)
+            self._cool_down('throttled')
+        elif generation.upstream_error:
+            self.errors += 1
+            if self.errors >= self.error_threshold:
+                self._cool_down('errors')
+        elif generation.complete:
+            self.errors = 0
+            self.cooldown = self.base_cooldown
+
+    def _cool_down(self, reason):
+        print(f"Account {self.name} is {reason}, not sending it requests for {self.cooldown} seconds")
+        ACCOUNT_COOLDOWNS.labels(self.name, reason).inc()
+        self.cooling_until = time.time() + self.cooldown
+        self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        self.errors = 0
+
+    def status(self):
+        wait = self.wait_time()
+        return {
+            "name": self.name,
+            "sessions": self.sessions,
+            "active_requests": self.active,
+            "requests": self.requests,
+            "tokens": round(self.tokens, 2) if self.requests_per_minute else None,
+            "requests_per_minute": self.requests_per_minute or None,
+            "cooling_down_for": math.ceil(max(0, self.cooling_until - time.time())) or None,
+            "available_in": round(wait, 1) if wait else 0,
+            "times_throttled": self.times_throttled
+        }
+
+def load_accounts(entries, sessions=1, requests_per_minute=0, burst=0, cooldown=60):
+    # entries is the JSON list from --accounts or VENICE_ACCOUNTS, each with
+    # a username and password or a seed and optionally its own name,
+    # sessions, requests_per_minute and burst.
+    accounts = []
+    for number, entry in enumerate(entries, 1):
+        if not entry.get('seed') and not (entry.get('username') and entry.get('password')):
+            raise ValueError(f"Account {number} needs either a seed or both a username and a password")
+        # The name shows up in /metrics and /api/sessions, so it defaults to
+        # a hash rather than the username, which is an email address
+        if entry.get('username'):
+            name = entry.get('name') or f"user-{hashlib.sha256(entry['username'].encode('utf-8')).hexdigest()[:8]}"
+        else:
+            name = entry.get('name') or f"seed-{hashlib.sha256(entry['seed'].encode('utf-8')).hexdigest()[:8]}"
+        accounts.append(Account(name, entry.get('username'), entry.get('password'), entry.get('seed'),
+                                sessions=entry.get('sessions', sessions),
+                                requests_per_minute=entry.get('requests_per_minute', requests_per_minute),
+                                burst=entry.get('burst', burst), cooldown=cooldown))
+    if len({account.name for account in accounts}) < len(accounts):
+        raise ValueError("Account names must be unique")
+    return accounts
+
+
+class BrowserSession:
+    """One logged-in WebDriver session.
+
+    In the ui fetch mode a session serves a single generation at a time. In
+    the page fetch mode several requests can stream on the same tab; their
+    chunks are collected together and filed per request in page_streams.
+    """
+
+    def __init__(self, session_id, account):
+        self.id = session_id
+        self.account = account
+        self.driver = None
+        self.generation = 0
+        self.active = 0
+        self.healthy = False
+        self.requests_served = 0
+        self.last_error = None
+        self.page_streams = {}
+        self.collect_lock = Semaphore()
+        self.requests_since_reload = 0
+        self.login_failures = 0
+        self.rss_bytes = None
+        self.recycling = False
+        self.retired = False
+        self.profile_index = 0
+        self.prepared = False
+
+    def collect_page_stream(self, request_id):
+        stream = self.page_streams[request_id]
+        if not stream['chunks'] and not stream['done']:
+            # Whoever holds the lock polls for every request in flight on
+            # this tab, so the others find their data already filed.
+            with self.collect_lock:
+                if not stream['chunks'] and not stream['done']:
+                    self._collect_all()
+        chunks = stream['chunks']
+        stream['chunks'] = []
+        return chunks, stream['done'], stream['status'], stream['error']
+
+    def _collect_all(self):
+        request_ids = [request_id for request_id, stream in self.page_streams.items() if not stream['done']]
+        result = self.driver.execute_async_script(COLLECT_PAGE_STREAMS_SCRIPT, request_ids, CHUNK_WAIT_MS)
+        if result is None:
+            print(f"Page bridge disappeared from session {self.id}, in-flight requests were lost")
+            result = {}
+            for request_id in request_ids:
+                result[request_id] = {"data": None, "done": True, "status": None, "error": None}
+        for request_id, update in result.items():
+            stream = self.page_streams.get(request_id)
+            if stream is not None and not stream['done']:
+                if update['data']:
+                    stream['chunks'].append(base64.b64decode(update['data']))
+                stream['done'] = update['done']
+                stream['status'] = update['status']
+                stream['error'] = update.get('error')
+
+    def status(self):
+        if self.healthy:
+            state = "busy" if self.active > 0 else "idle"
+        else:
+            state = "broken" if self.last_error else "starting"
+        return {
+            "id": self.id,
+            "account": self.account.name,
+            "state": state,
+            "active_requests": self.active,
+            "requests_served": self.requests_served,
+            "rss_bytes": self.rss_bytes,
+            "recycling": self.recycling,
+            "last_error": self.last_error
+        }
+
+
+def process_tree_rss(pid):
+    # Resident memory of a process and all its descendants. Linux only,
+    # returns None elsewhere.
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        process = pending.pop()
+        try:
+            with open(f"/proc/{process}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+        pending.extend(children.get(process, []))
+    return total
+
+def browser_rss(driver):
+    # chromedriver is the parent of the browser and its renderer processes
+    try:
+        return process_tree_rss(driver.service.process.pid)
+    except AttributeError:
+        return None
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops sending requests to Venice while it keeps failing.
+
+    After `threshold` consecutive failed generations or logins the breaker
+    opens and requests are answered with 503 right away. Once the cooldown
+    has passed, one trial request is let through: if it completes the
+    breaker closes, otherwise it opens again with twice the cooldown, up to
+    max_cooldown seconds.
+    """
+
+    def __init__(self, threshold=5, cooldown=30, max_cooldown=600):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self.times_opened = 0
+
+    def allow(self):
+        if self.state == "closed":
+            return
+        now = time.time()
+        if self.state == "open" and now - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            self.trial_started = None
+        # A trial without a verdict (never started or abandoned) is retried after the cooldown
+        if self.state == "half_open" and (self.trial_started is None or now - self.trial_started >= self.cooldown):
+            self.trial_started = now
+            return
+        raise CircuitOpen(f"Venice is failing, not sending requests for {self.retry_after()} seconds")
+
+    def abandon(self):
+        # The trial request ended without telling whether Venice works
+        self.trial_started = None
+
+    def record_success(self):
+        if self.state != "closed":
+            print("Venice answered again, closing the circuit breaker")
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self._open()
+        elif self.state == "closed" and self.failures >= self.threshold:
+            self._open()
+
+    def _open(self):
+        print(f"Opening the circuit breaker after {self.failures} consecutive failures, retrying Venice in {self.cooldown} seconds")
+        self.state = "open"
+        self.opened_at = time.time()
+        self.times_opened += 1
+
+    def watch(self, contents, generation):
+        # Judges Venice by whether the generation completed without an
+        # error. A client that disconnects says nothing about Venice.
+        with closing(contents):
+            try:
+                yield from contents
+            except GeneratorExit:
+                self.abandon()
+                raise
+            except Exception:
+                self.record_failure()
+                raise
+        if generation.complete and not generation.upstream_error:
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def retry_after(self):
+        if self.state == "open":
+            return max(1, math.ceil(self.cooldown - (time.time() - self.opened_at)))
+        return max(1, math.ceil(self.cooldown))
+
+    def status(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "cooldown_seconds": self.cooldown,
+            "times_opened": self.times_opened,
+            "retry_after": self.retry_after() if self.state != "closed" else None
+        }
+
+
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+
+
+class RequestQueue:
+    """Requests waiting for a free session slot.
+
+    Waiters are grouped by priority class and the lowest class number is
+    served first. Within a class clients take turns, and each client's own
+    requests are served in arrival order, so one client sending a burst
+    cannot starve the others.
+    """
+
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self.classes = {}
+        self.depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def push(self, waiter, priority, client, bounded=True):
+        if bounded and self.depth >= self.max_depth:
+            self.rejected += 1
+            raise QueueFull(f"{self.depth} requests are already waiting for a session")
+        clients = self.classes.setdefault(priority, OrderedDict())
+        clients.setdefault(client, deque()).append(waiter)
+        self.depth += 1
+
+    def pop(self):
+        for priority in sorted(self.classes):
+            clients = self.classes[priority]
+            client, waiters = next(iter(clients.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+                if not clients:
+                    del self.classes[priority]
+            self.depth -= 1
+            return waiter
+        return None
+
+    def remove(self, waiter, priority, client):
+        clients = self.classes[priority]
+        clients[client].remove(waiter)
+        if not clients[client]:
+            del clients[client]
+            if not clients:
+                del self.classes[priority]
+        self.depth -= 1
+
+    def record_wait(self, seconds):
+        self.admitted += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def status(self):
+        return {
+            "depth": self.depth,
+            "depth_by_priority": {name: sum(len(waiters) for waiters in self.classes.get(priority, {}).values()) for name, priority in PRIORITY_CLASSES.items()},
+            "max_depth": self.max_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3)
+        }
+
+
+class SessionLease:
+    """A checked out session slot. Releasing it more than once is harmless,
+    so both the response generator and the response close hook can do it.
+    """
+
+    def __init__(self, pool, session, generation, priority, client):
+        self.pool = pool
+        self.session = session
+        self.generation = generation
+        self.priority = priority
+        self.client = client
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool._release(self.session, self.generation)
+
+
+class SessionPool:
+    """Fixed-size pool of browser sessions, each logged in to one of the
+    accounts and offering `slots` concurrent checkouts. Requests wait in a
+    bounded RequestQueue while no slot is free, and failed sessions are
+    replaced in the background.
+    """
+
+    relogin_delay = 5
+    max_relogin_delay = 300
+
+    def __init__(self, accounts, slots=1, max_queue=64, max_wait=120, profile_dir=None,
+                 watchdog_interval=30, recycle_tab_after=0, recycle_session_after=0, recycle_memory=0, prewarm=False):
+        self.accounts = accounts
+        self.sessions = []
+        for account in accounts:
+            for _ in range(account.sessions):
+                self.sessions.append(BrowserSession(len(self.sessions), account))
+        self.slots = slots
+        self.profile_dir = profile_dir
+        self.max_wait = max_wait
+        self.idle = deque()
+        self.queue = RequestQueue(max_queue)
+        self.watchdog_interval = watchdog_interval
+        self.recycle_tab_after = recycle_tab_after
+        self.recycle_session_after = recycle_session_after
+        self.recycle_memory = recycle_memory
+        self.prewarm = prewarm
+        self.dispatch_timer = None
+
+    def start(self):
+        gevent.joinall([gevent.spawn(self._login, session) for session in self.sessions])
+        if not any(session.healthy for session in self.sessions):
+            print("None of the browser sessions could log in to Venice", file=sys.stderr)
+            sys.exit(1)
+
+    def _login(self, session):
+        try:
+            with STAGE_SECONDS.labels('login').time():
+                session.driver = login_to_venice(self.session_profile_dir(session), session.account)
+        except Exception as e:
+            session.driver = None
+            session.last_error = str(e)
+            session.login_failures += 1
+            circuit_breaker.record_failure()
+            delay = min(self.max_relogin_delay, self.relogin_delay * 2 ** (session.login_failures - 1))
+            print(f"Session {session.id} failed to log in: {e}, retrying in {delay} seconds", file=sys.stderr)
+            gevent.spawn_later(delay, self._login, session)
+            return
+        session.login_failures = 0
+        session.generation += 1
+        session.healthy = True
+        session.last_error = None
+        for _ in range(self.slots):
+            self._offer(session, session.generation)
+
+    def session_profile_dir(self, session):
+        if self.profile_dir is None:
+            return None
+        # A replacement logs in while the session it replaces still runs,
+        # so the two alternate between profile directories.
+        suffix = "-b" if session.profile_index else ""
+        if session.account.name == 'default':
+            return os.path.join(self.profile_dir, f"session-{session.id}{suffix}")
+        return os.path.join(self.profile_dir, session.account.name, f"session-{session.id}{suffix}")
+
+    def _replace(self, session):
+        print(f"Replacing browser session {session.id}")
+        RELOGINS.inc()
+        self._quit(session)
+        session.page_streams.clear()
+        session.prepared = False
+        self._login(session)
+
+    def watch(self):
+        # Reloads the tab of a session once it has served recycle_tab_after
+        # requests, and replaces the whole session once it has served
+        # recycle_session_after requests or its browser uses more than
+        # recycle_memory bytes. The replacement logs in before it takes
+        # over, so recycling does not delay requests.
+        while True:
+            gevent.sleep(self.watchdog_interval)
+            for session in list(self.sessions):
+                if not session.healthy or session.recycling or session.driver is None:
+                    continue
+                session.rss_bytes = browser_rss(session.driver)
+                if self.recycle_memory and session.rss_bytes and session.rss_bytes > self.recycle_memory:
+                    session.recycling = True
+                    gevent.spawn(self._recycle, session, 'memory')
+                elif self.recycle_session_after and session.requests_served >= self.recycle_session_after:
+                    session.recycling = True
+                    gevent.spawn(self._recycle, session, 'requests')
+                elif self.recycle_tab_after and session.requests_since_reload >= self.recycle_tab_after:
+                    self._reload_tab(session)
+
+    def _reload_tab(self, session):
+        # Only reloads a session with all of its slots idle, taking them
+        # out of the idle list so nothing checks it out meanwhile.
+        slots = [slot for slot in self.idle if slot == (session, session.generation)]
+        if session.active or len(slots) < self.slots:
+            return
+        for slot in slots:
+            self.idle.remove(slot)
+        # The reload drops a prepared conversation and its interceptor
+        session.prepared = False
+        try:
+            session.driver.get(f"{venice_url}/chat")
+            ensure_logged_in(session.driver, max_attempts=1)
+        except WebDriverException as e:
+            print(f"Session {session.id} failed to reload its tab: {e.msg}")
+            session.healthy = False
+            session.last_error = str(e)
+            gevent.spawn(self._replace, session)
+            return
+        RECYCLES.labels('tab').inc()
+        session.requests_since_reload = 0
+        for _ in slots:
+            self._offer(session, session.generation)
+
+    def _recycle(self, session, reason):
+        print(f"Recycling browser session {session.id} ({reason}), logging in its replacement")
+        replacement = BrowserSession(session.id, session.account)
+        replacement.profile_index = 1 - session.profile_index
+        try:
+            with STAGE_SECONDS.labels('login').time():
+                replacement.driver = login_to_venice(self.session_profile_dir(replacement), replacement.account)
+        except Exception as e:
+            print(f"Could not log in a replacement for session {session.id}: {e}", file=sys.stderr)
+            session.recycling = False
+            if not session.healthy and session.active == 0:
+                gevent.spawn(self._replace, session)
+            return
+
+        RECYCLES.labels(reason).inc()
+        replacement.generation = 1
+        replacement.healthy = True
+        self.sessions[self.sessions.index(session)] = replacement
+        # The old session finishes its requests and quits after the last one
+        session.retired = True
+        session.healthy = False
+        for _ in range(self.slots):
+            self._offer(replacement, replacement.generation)
+        if session.active == 0:
+            self._quit(session)
+
+    def _prepare(self, session, generation):
+        # With prewarm, a session released while no request waits opens a
+        # fresh conversation ready for the next submit. The slot is out of
+        # the idle list meanwhile, so the tab is not used by a request while
+        # it is being prepared.
+        try:
+            with STAGE_SECONDS.labels('prewarm').time():
+                prepare_chat_page(session.driver, fresh=True)
+            session.prepared = True
+        except WebDriverException as e:
+            print(f"Session {session.id} failed to prepare the chat page: {e.msg}")
+            session.prepared = False
+        self._offer(session, generation)
+
+    def _quit(self, session):
+        try:
+            session.driver.quit()
+        except WebDriverException as e:
+            print(f"Error occurred while quitting WebDriver: {e}")
+        session.driver = None
+
+    def _offer(self, session, generation):
+        self.idle.append((session, generation))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.queue.depth:
+            slot = self._take_idle()
+            if slot is None:
+                break
+            self.queue.pop().set(slot)
+        if self.queue.depth and self.idle and self.dispatch_timer is None:
+            # Slots are idle but their accounts are cooling down or out of
+            # requests, look again once the first of them is available
+            delay = min(session.account.wait_time() for session, generation in self.idle)
+            self.dispatch_timer = gevent.spawn_later(max(delay, 0.05), self._dispatch_later)
+
+    def _dispatch_later(self):
+        self.dispatch_timer = None
+        self._dispatch()
+
+    def _take_idle(self, exclude=None):
+        # Idle slots carry the login generation of their session, slots of
+        # a replaced session are dropped. The slot goes to the least loaded
+        # account that has a request left in its token bucket and is not
+        # cooling down, the one throttled longest ago first.
+        best = None
+        ready = {}
+        for slot in list(self.idle):
+            session, generation = slot
+            if not session.healthy or generation != session.generation:
+                self.idle.remove(slot)
+                continue
+            if session is exclude:
+                continue
+            account = session.account
+            if account not in ready:
+                ready[account] = account.ready()
+            if not ready[account]:
+                continue
+            load = (account.active / (account.sessions * self.slots), account.last_throttled or 0, session.active)
+            if best is None or load < best[0]:
+                best = (load, slot)
+        if best is None:
+            return None
+        self.idle.remove(best[1])
+        best[1][0].account.take()
+        return best[1]
+
+    def checkout(self, priority=PRIORITY_CLASSES["normal"], client=None, bounded=True):
+        start_time = time.time()
+        # Waiters held back by their accounts' limits keep their turn
+        slot = self._take_idle() if not self.queue.depth else None
+        if slot is None:
+            waiter = AsyncResult()
+            self.queue.push(waiter, priority, client, bounded)
+            self._dispatch()
+            try:
+                slot = waiter.get(timeout=self.max_wait if bounded else None)
+            except gevent.Timeout:
+                if not waiter.ready():
+                    self.queue.remove(waiter, priority, client)
+                    self.queue.timed_out += 1
+                    raise QueueTimeout(f"No session became free within {self.max_wait} seconds")
+                slot = waiter.get()
+            except BaseException:
+                # The waiting greenlet was killed, pass a slot granted meanwhile on
+                if waiter.ready():
+                    self._offer(*waiter.get())
+                else:
+                    self.queue.remove(waiter, priority, client)
+                raise
+        self.queue.record_wait(time.time() - start_time)
+        STAGE_SECONDS.labels('queue_wait').observe(time.time() - start_time)
+        return self._lease(slot, priority, client)
+
+    def try_checkout(self, priority=PRIORITY_CLASSES["normal"], client=None, exclude=None):
+        # A slot of another session than `exclude` if one is idle right
+        # now, otherwise None. For optional work that should not queue.
+        if self.queue.depth:
+            return None
+        slot = self._take_idle(exclude)
+        if slot is None:
+            return None
+        return self._lease(slot, priority, client)
+
+    def _lease(self, slot, priority, client):
+        session, generation = slot
+        session.active += 1
+        session.account.active += 1
+        return SessionLease(self, session, generation, priority, client)
+
+    def _release(self, session, generation):
+        session.active -= 1
+        session.account.active -= 1
+        session.requests_served += 1
+        session.requests_since_reload += 1
+        if session.healthy and generation == session.generation:
+            if self.prewarm and not self.queue.depth:
+                gevent.spawn(self._prepare, session, generation)
+            else:
+                self._offer(session, generation)
+        elif session.retired:
+            if session.active == 0:
+                self._quit(session)
+        elif session.active == 0 and not session.recycling:
+            gevent.spawn(self._replace, session)
+
+    @contextmanager
+    def session(self, priority=PRIORITY_CLASSES["high"]):
+        # Checkouts for the server's own housekeeping, not bound by the queue limits
+        lease = self.checkout(priority, client=None, bounded=False)
+        try:
+            yield lease.session
+        finally:
+            lease.release()
+
+    def retry_after(self):
+        # Seconds until the queue has likely drained enough to admit a request
+        slots = max(1, sum(1 for session in self.sessions if session.healthy) * self.slots)
+        average = generation_stats.completed_seconds / generation_stats.completed if generation_stats.completed else 10
+        return max(1, math.ceil((self.queue.depth + 1) * average / slots))
+
+    def status(self):
+        return [session.status() for session in self.sessions]
+
+# Replaces the body of the next chat request the page sends with
+# window.interceptedApiData and tees its response stream into
+# window.receivedChunks. Installed before the request is submitted, possibly
+# ahead of time while the session is idle.
+INSTALL_INTERCEPTOR_SCRIPT = """
     window.streamComplete = false;
+    window.streamError = null;
+    window.streamStatus = null;
     window.receivedChunks = [];
-    (function(original) {{
-      const apiData = {api_data_json};
-      window.fetch = async function() {{
+    window.notifyChunks = null;
+    window.streamAbort = null;
+    // Installing twice would intercept the request twice
+    if (!window.interceptorReady) (function(original) {
+      window.interceptorReady = true;
+      window.fetch = async function() {
         let url = arguments[0];
         let options = arguments[1];
 
-        if (url.includes('/api/inference/chat') && options.method === 'POST') {{
+        if (url.includes('/api/inference/chat') && options.method === 'POST') {
           window.fetch = original;
+          window.interceptorReady = false;
+          const apiData = window.interceptedApiData;
           let body = JSON.parse(options.body);
-          if ('requestId' in body) {{
+          if ('requestId' in body) {
             delete apiData.requestId;
-          }}
+          }
           Object.assign(body, apiData);
           options.body = JSON.stringify(body);
           options.headers['Content-Length'] = new Blob([options.body]).size.toString();
 
+          // Let Python abort the request when its client goes away
+          const abortController = new AbortController();
+          if (options.signal) {
+            options.signal.addEventListener('abort', () => abortController.abort());
+          }
+          options.signal = abortController.signal;
+          window.streamAbort = abortController;
 
           // Perform the fetch and get the response
           const response = await original.apply(this, arguments);
+          window.streamStatus = response.status;
           const reader = response.body.getReader();
 
           // Set up a stream for the Python code to read
-          window.responseStream = new ReadableStream({{
-            start(controller) {{
-              function push() {{
-                reader.read().then(({{ done, value }}) => {{
-                  if (done) {{
+          window.responseStream = new ReadableStream({
+            start(controller) {
+              function push() {
+                reader.read().then(({ done, value }) => {
+                  if (done) {
                     controller.close();
                     window.streamComplete = true;
+                    if (window.notifyChunks) window.notifyChunks();
                     return;
-                  }}
+                  }
                   window.receivedChunks.push(value);
+                  if (window.notifyChunks) window.notifyChunks();
                   controller.enqueue(value);
                   push();
-                }});
-              }}
+                }).catch(error => {
+                  // Ends the polling, but the stream was cut off
+                  controller.error(error);
+                  window.streamError = String(error);
+                  window.streamComplete = true;
+                  if (window.notifyChunks) window.notifyChunks();
+                });
+              }
               push();
-            }}
-          }});
+            }
+          });
 
           // Return a new response with our custom stream
-          return new Response(window.responseStream, {{
+          return new Response(window.responseStream, {
             headers: response.headers,
             status: response.status,
             statusText: response.statusText
-          }});
-        }}
+          });
+        }
 
         return original.apply(this, arguments);
-      }};
-    }})(window.fetch);
-    """
-    driver.execute_script(script)
+      };
+    })(window.fetch);
+"""
+
+# Submits the prepared chat page with the request's data. Returns false
+# while the submit button is not enabled yet, or when the interceptor is
+# gone because the page changed since it was prepared.
+SUBMIT_PREPARED_SCRIPT = """
+const button = document.querySelector("button[type='submit'][aria-label='submit']");
+if (!window.interceptorReady || !button || button.disabled) return false;
+window.interceptedApiData = arguments[0];
+button.click();
+return true;
+"""
+
+# Received Uint8Arrays would cross the WebDriver boundary as JSON arrays of
+# integers, roughly four bytes per byte. Every poll instead concatenates
+# them and hands Python a single base64 string.
+PACK_CHUNKS_JS = """
+function packChunks(chunks) {
+    if (chunks.length === 0) return null;
+    let length = 0;
+    for (const chunk of chunks) length += chunk.length;
+    const bytes = new Uint8Array(length);
+    let offset = 0;
+    for (const chunk of chunks) {
+        bytes.set(chunk, offset);
+        offset += chunk.length;
+    }
+    let binary = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(binary);
+}
+"""
+
+# Long poll for intercepted chunks: resolves as soon as the interceptor
+# pushes data or finishes the stream, or after the wait (ms) elapses.
+WAIT_FOR_CHUNKS_SCRIPT = PACK_CHUNKS_JS + """
+    const wait = arguments[0];
+    const callback = arguments[arguments.length - 1];
+    let timer = null;
+    function flush() {
+        clearTimeout(timer);
+        window.notifyChunks = null;
+        const chunks = window.receivedChunks ? window.receivedChunks.splice(0, window.receivedChunks.length) : [];
+        callback({data: packChunks(chunks), complete: window.streamComplete === true, error: window.streamError || null,
+                  status: window.streamStatus});
+    }
+    if ((window.receivedChunks && window.receivedChunks.length > 0) || window.streamComplete) {
+        flush();
+    } else {
+        timer = setTimeout(flush, wait);
+        window.notifyChunks = flush;
+    }
+"""
+CHUNK_WAIT_MS = 1000
+
+ABORT_INTERCEPTED_REQUEST_SCRIPT = """
+if (window.streamAbort) window.streamAbort.abort();
+window.receivedChunks = [];
+window.streamComplete = true;
+"""
+
+def wait_for_chunks(driver):
+    return driver.execute_async_script(WAIT_FOR_CHUNKS_SCRIPT, CHUNK_WAIT_MS)
+
+# Persistent in-page helper for the page fetch mode. It posts to
+# /api/inference/chat itself with the page's cookies and keeps every
+# response stream in its own buffer keyed by requestId, so several
+# requests can be in flight on one tab.
+PAGE_BRIDGE_SCRIPT = PACK_CHUNKS_JS + """
+if (!window.veniceBridge) {
+    const nativeFetch = window.fetch.bind(window);
+    window.veniceBridge = {
+        streams: {},
+        waiter: null,
+        notify() {
+            if (this.waiter) this.waiter();
+        },
+        async start(requestId, apiData) {
+            const stream = {chunks: [], done: false, status: null, error: null, controller: new AbortController()};
+            this.streams[requestId] = stream;
+            try {
+                const response = await nativeFetch('/api/inference/chat', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify(apiData),
+                    credentials: 'include',
+                    signal: stream.controller.signal
+                });
+                stream.status = response.status;
+                if (response.ok) {
+                    const reader = response.body.getReader();
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        if (done) break;
+                        stream.chunks.push(value);
+                        this.notify();
+                    }
+                }
+            } catch (error) {
+                // A stream cut off after a 200 is done, but not complete
+                stream.error = String(error);
+                if (error.name !== 'AbortError') console.error('Venice bridge request failed:', error);
+            }
+            stream.done = true;
+            this.notify();
+        },
+        abort(requestId) {
+            const stream = this.streams[requestId];
+            if (stream) {
+                delete this.streams[requestId];
+                stream.controller.abort();
+            }
+        },
+        collect(requestIds, wait, callback) {
+            let timer = null;
+            const flush = () => {
+                clearTimeout(timer);
+                this.waiter = null;
+                const result = {};
+                for (const requestId of requestIds) {
+                    const stream = this.streams[requestId];
+                    if (!stream) {
+                        result[requestId] = {data: null, done: true, status: null, error: null};
+                        continue;
+                    }
+                    result[requestId] = {data: packChunks(stream.chunks.splice(0, stream.chunks.length)), done: stream.done, status: stream.status, error: stream.error};
+                    if (stream.done) delete this.streams[requestId];
+                }
+                callback(result);
+            };
+            const ready = requestIds.some(requestId => {
+                const stream = this.streams[requestId];
+                return !stream || stream.chunks.length > 0 || stream.done;
+            });
+            if (ready) {
+                flush();
+            } else {
+                timer = setTimeout(flush, wait);
+                this.waiter = flush;
+            }
+        }
+    };
+}
+"""
+
+START_PAGE_FETCH_SCRIPT = PAGE_BRIDGE_SCRIPT + """
+window.veniceBridge.start(arguments[0], arguments[1]);
+"""
+
+ABORT_PAGE_FETCH_SCRIPT = """
+if (window.veniceBridge) window.veniceBridge.abort(arguments[0]);
+"""
+
+# Long poll over all requests in flight on a tab. Resolves with null when
+# the page navigated and the bridge (and its streams) are gone.
+COLLECT_PAGE_STREAMS_SCRIPT = """
+const callback = arguments[arguments.length - 1];
+if (!window.veniceBridge) {
+    callback(null);
+} else {
+    window.veniceBridge.collect(arguments[0], arguments[1], callback);
+}
+"""
 
 def presence_of_either_element_located(locators):
     def _predicate(driver):
@@ -553,10 +1529,9 @@ def presence_of_either_element_located(locators):
         return False
     return _predicate
 
-def generate_selenium_streamed_response(data, driver, response_format=ResponseFormat.CHAT):
-    global timeout
+def build_api_data(data):
     request_id = str(uuid.uuid4())[:8]
-    model_id = data.get('model', 'llama-3.1-405b-akash-api')
+    model_id = data.get('model') or model_catalog.default_model()
     request_model_id = model_id
     if ':latest' in request_model_id:
         request_model_id = request_model_id.split(':latest')[0]
@@ -570,24 +1545,97 @@ def generate_selenium_streamed_response(data, driver, response_format=ResponseFo
         "temperature": 0.8,
         "topP": 0.9
     }
+    return model_id, api_data
 
-    api_data_json = json.dumps(api_data)
-    try:
-        if not driver.current_url.startswith('https://venice.ai/chat'):
-            driver.get('https://venice.ai/chat')
+THROTTLING_PATTERN = re.compile(r'rate.?limit|too many requests|quota|throttl', re.IGNORECASE)
+
+class Generation:
+    """One request to Venice. The chunk sources mark it complete when Venice
+    ends the stream, as opposed to a timeout or a failed request. Stopping
+    early at the client's token limit or stop sequence also completes it,
+    with done_reason telling why. Errors Venice reports are kept in
+    upstream_error, with throttled set when it was a rate limit.
+    """
+
+    def __init__(self, data, received_at=None):
+        self.model_id, self.api_data = build_api_data(data)
+        self.messages = data['messages']
+        self.complete = False
+        self.done_reason = None
+        self.upstream_error = None
+        self.throttled = False
+        # Set on the copy of a hedged request that another copy beat
+        self.hedge_lost = False
+
+        # When the request arrived, got its session, was sent to Venice and
+        # got its first content, for the durations of the final message
+        self.admitted_at = time.time()
+        self.received_at = received_at or self.admitted_at
+        self.submitted_at = None
+        self.first_chunk_at = None
+
+        # Ollama passes the limits in options, OpenAI at the top level
+        options = data.get('options') or {}
+        max_tokens = options.get('num_predict', data.get('max_completion_tokens', data.get('max_tokens')))
+        self.max_tokens = max_tokens if isinstance(max_tokens, int) and max_tokens >= 0 else None
+        stop = options.get('stop', data.get('stop'))
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stop = [sequence for sequence in stop or [] if isinstance(sequence, str) and sequence]
+
+    def stop_early(self, reason):
+        self.done_reason = reason
+        self.complete = True
+
+    def hedge(self, request_id=None):
+        # The same request once more, by default under a request id of its own
+        hedge = copy.copy(self)
+        hedge.api_data = dict(self.api_data, requestId=request_id or str(uuid.uuid4())[:8])
+        return hedge
+
+    def fail(self, error, status=None):
+        self.upstream_error = error
+        self.throttled = status == 429 or THROTTLING_PATTERN.search(error) is not None
+
+def prepare_chat_page(driver, fresh=False):
+    # Gets the tab to a conversation with text in the textarea and the
+    # interceptor installed, so the request only needs the submit click.
+    # Returns the seconds spent on navigation.
+    navigation_start = time.time()
+    if fresh or not driver.current_url.startswith(f"{venice_url}/chat"):
+        driver.get(f"{venice_url}/chat")
+    navigation_seconds = time.time() - navigation_start
+
+    element = WebDriverWait(driver, selenium_timeout).until(
+        presence_of_either_element_located((
+            (By.XPATH, "//button[.//p[contains(text(), 'Text Conversation')]]"),
+            (By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]")
+        ))
+    )
 
+    if element.tag_name == 'button':
+        element.click()
         element = WebDriverWait(driver, selenium_timeout).until(
-            presence_of_either_element_located((
-                (By.XPATH, "//button[.//p[contains(text(), 'Text Conversation')]]"),
-                (By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]")
-            ))
+            EC.element_to_be_clickable((By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]"))
         )
+    WebDriverWait(driver, selenium_timeout).until(
+        lambda d: element.is_displayed() and element.is_enabled()
+    )
 
-        if element.tag_name == 'button':
-            element.click()
-            element = WebDriverWait(driver, selenium_timeout).until(
-                EC.element_to_be_clickable((By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]"))
-            )
+    element.click()
+    element.send_keys(" ")
+
+    current_url = driver.current_url
+
+    # If we are on the main chat page, the button will navigate us to a different url first
+    if current_url == f"{venice_url}/chat":
+        WebDriverWait(driver, selenium_timeout).until(
+            EC.element_to_be_clickable((By.XPATH, "//button[@type='submit' and @aria-label='submit']"))
+        ).click()
+        WebDriverWait(driver, selenium_timeout).until(EC.url_changes(current_url))
+        element = WebDriverWait(driver, selenium_timeout).until(
+            EC.element_to_be_clickable((By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]"))
+        )
         WebDriverWait(driver, selenium_timeout).until(
             lambda d: element.is_displayed() and element.is_enabled()
         )
@@ -595,123 +1643,1122 @@ def generate_selenium_streamed_response(data, driver, response_format=ResponseFo
         element.click()
         element.send_keys(" ")
 
-        current_url = driver.current_url
+    driver.execute_script(INSTALL_INTERCEPTOR_SCRIPT)
+    return navigation_seconds
+
+def submit_chat_request(driver, api_data, prepared=False):
+    ui_start = time.time()
+    if prepared:
+        if driver.execute_script(SUBMIT_PREPARED_SCRIPT, api_data):
+            STAGE_SECONDS.labels('navigation').observe(0)
+            STAGE_SECONDS.labels('ui').observe(time.time() - ui_start)
+            return
+        print("The prepared chat page changed meanwhile, preparing it again")
+
+    navigation_seconds = prepare_chat_page(driver)
+    STAGE_SECONDS.labels('navigation').observe(navigation_seconds)
+    WebDriverWait(driver, selenium_timeout).until(lambda d: d.execute_script(SUBMIT_PREPARED_SCRIPT, api_data))
+    STAGE_SECONDS.labels('ui').observe(time.time() - ui_start - navigation_seconds)
+
+def intercepted_chunks(driver, generation):
+    last_data_time = time.time()
+    while True:
+        result = wait_for_chunks(driver)
+        if result['data']:
+            last_data_time = time.time()
+            yield base64.b64decode(result['data'])
+
+        if result['complete']:
+            status = result.get('status')
+            if result.get('error'):
+                print(f"The Venice stream broke off: {result['error']}")
+                generation.fail(result['error'], status)
+            elif status is not None and not 200 <= status < 300:
+                print(f"Intercepted request failed with status {status}")
+                generation.fail(f"Venice answered {status}", status)
+            else:
+                generation.complete = True
+            break
+        if time.time() - last_data_time > timeout:
+            print(f"Timeout: No data received for {timeout} seconds. Exiting loop.")
+            TIMEOUTS.inc()
+            driver.execute_script(ABORT_INTERCEPTED_REQUEST_SCRIPT)
+            break
 
-        # If we are on the main chat page, the button will navigate us to a different url first
-        if current_url == 'https://venice.ai/chat':
-            WebDriverWait(driver, selenium_timeout).until(
-                EC.element_to_be_clickable((By.XPATH, "//button[@type='submit' and @aria-label='submit']"))
-            ).click()
-            WebDriverWait(driver, selenium_timeout).until(EC.url_changes(current_url))
-            element = WebDriverWait(driver, selenium_timeout).until(
-                EC.element_to_be_clickable((By.XPATH, "//textarea[contains(@placeholder, 'Ask a question')]"))
-            )
-            WebDriverWait(driver, selenium_timeout).until(
-                lambda d: element.is_displayed() and element.is_enabled()
-            )
+    capture_and_redirect_browser_logs(driver)
 
-            element.click()
-            element.send_keys(" ")
+class NDJSONDecoder:
+    """Incremental decoder for Venice's newline delimited JSON stream.
 
+    Chunks may split a line, or a multi-byte UTF-8 character, at any byte.
+    The bytes after the last newline of a chunk are kept in a bytearray
+    until the line is complete. Everything up to that newline is decoded
+    and split in one pass; a newline byte never occurs inside a multi-byte
+    character, so characters are never decoded half-way.
+    """
 
-        inject_request_interceptor(driver, api_data_json)
+    def __init__(self):
+        self.pending = bytearray()
+
+    def feed(self, chunk):
+        end = chunk.rfind(b'\n')
+        if end == -1:
+            self.pending += chunk
+            return []
+
+        pending = self.pending
+        if pending:
+            pending += chunk[:end]
+            text = pending.decode('utf-8', 'replace')
+            pending.clear()
+        else:
+            text = chunk[:end].decode('utf-8', 'replace')
+        if end + 1 < len(chunk):
+            pending += chunk[end + 1:]
+        return self._parse(text.split('\n'))
+
+    def close(self):
+        if not self.pending:
+            return []
+        text = self.pending.decode('utf-8', 'replace')
+        self.pending.clear()
+        return self._parse((text,))
+
+    def _parse(self, lines):
+        objects = []
+        for line in lines:
+            if line:
+                try:
+                    objects.append(json.loads(line))
+                except json.JSONDecodeError:
+                    if not line.isspace():
+                        JSON_PARSE_FAILURES.inc()
+                        print(f"Failed to parse line: {line}")
+        return objects
+
+def iter_ndjson(chunks):
+    decoder = NDJSONDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+# Splits text the way BPE tokenizers pre-tokenize it: contractions, words
+# with their leading space, groups of up to three digits, punctuation runs
+# and whitespace.
+PRETOKEN_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+")
+
+def pretoken_count(pretoken):
+    # Common words are a single token and longer ones split into pieces of
+    # about six characters. Non-ASCII text (accents, CJK) takes about a
+    # token per character.
+    if pretoken.isascii():
+        return (len(pretoken) + 5) // 6 if pretoken[-1].isalpha() else (len(pretoken) + 2) // 3
+    return max(1, (len(pretoken.encode('utf-8')) + 2) // 3)
+
+def estimate_token_count(text):
+    return sum(map(pretoken_count, PRETOKEN_PATTERN.findall(text)))
+
+# Tokens chat models spend on the role and separators of each message, and
+# on priming the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+def estimate_content_tokens(content):
+    # OpenAI clients may send the content as a list of parts, of which only
+    # the text parts are counted
+    if isinstance(content, str):
+        return estimate_token_count(content)
+    if isinstance(content, list):
+        return sum(estimate_token_count(part.get('text') or '') for part in content
+                   if isinstance(part, dict) and part.get('type') == 'text')
+    return 0
+
+def estimate_prompt_tokens(messages):
+    return sum(estimate_content_tokens(message.get('content')) + MESSAGE_OVERHEAD_TOKENS for message in messages) + REPLY_OVERHEAD_TOKENS
+
+
+class TokenCounter:
+    """Estimates the tokens of text that arrives in pieces, giving the same
+    count as estimate_token_count on the whole text. The last pretoken of a
+    piece may continue in the next one, so it is counted once that arrives.
+    """
 
-        button = WebDriverWait(driver, selenium_timeout).until(
-            EC.element_to_be_clickable((By.XPATH, "//button[@type='submit' and @aria-label='submit']"))
-        )
+    def __init__(self):
+        self.tokens = 0
+        self.pending = ""
+
+    def take(self, piece, limit):
+        # Counts the piece up to the pretoken that reaches limit. Returns the
+        # part of the piece up to there, and whether the limit was reached.
+        text = self.pending + piece
+        pretokens = list(PRETOKEN_PATTERN.finditer(text))
+        for pretoken in pretokens[:-1]:
+            self.tokens += pretoken_count(pretoken.group())
+            if self.tokens >= limit:
+                self.pending = ""
+                return piece[:max(0, pretoken.end() - len(text) + len(piece))], True
+        self.pending = pretokens[-1].group() if pretokens else ""
+        return piece, False
+
+    def total(self):
+        return self.tokens + (pretoken_count(self.pending) if self.pending else 0)
+
+def dumps_json(value):
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
+
+# The same escaping json.dumps applies to a string, without its overhead
+json_string = encode_basestring_ascii
+
+
+class Timestamps:
+    """created_at values for streamed messages. Formatting a datetime for
+    every piece is costly, so the date and time are formatted once a second
+    and only the microseconds on each call.
+    """
 
-        button.click()
+    def __init__(self):
+        self.second = None
+        self.prefix = None
 
-        start_time = datetime.now(timezone.utc)
+    def now(self):
+        now = time.time()
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        return f"{self.prefix}.{int((now - second) * 1e6):06d}Z"
 
-        eval_count = 0
-        last_data_time = time.time()
-        streamed_content = ""
-        while True:
-            chunks = driver.execute_script("""
-                if (typeof window.receivedChunks !== 'undefined' && window.receivedChunks !== null) {
-                    return window.receivedChunks.splice(0, window.receivedChunks.length);
-                } else {
-                    return [];
+timestamps = Timestamps()
+
+
+class MessageTemplates:
+    """The streamed messages of one response, with everything but the
+    content and the timestamp encoded once per request. Gives the same text
+    as json.dumps of the message dicts.
+    """
+
+    def __init__(self, response_format, model_id, completion_id, created):
+        model = json_string(model_id)
+        self.middle = None
+        if response_format == ResponseFormat.OPENAI_STREAM:
+            self.head = ('data: {"id": ' + json_string(completion_id) + ', "object": "chat.completion.chunk", "created": ' + str(created) +
+                         ', "model": ' + model + ', "system_fingerprint": "fp_ollama", "choices": [{"index": 0, "delta": {"content": ')
+            self.tail = '}, "finish_reason": null}]}\n\n'
+        elif response_format == ResponseFormat.GENERATE:
+            self.head = '{"model": ' + model + ', "created_at": "'
+            self.middle = '", "response": '
+            self.tail = ', "done": false}\r\n'
+        else:
+            self.head = '{"model": ' + model + ', "created_at": "'
+            self.middle = '", "message": {"role": "assistant", "content": '
+            self.tail = '}, "done": false}\r\n'
+
+    def ollama(self, content):
+        return self.head + timestamps.now() + self.middle + json_string(content) + self.tail
+
+    def openai(self, content):
+        return self.head + json_string(content) + self.tail
+
+def openai_stream_event(completion_id, created, model_id, delta, finish_reason=None, usage=None):
+    event = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model_id,
+        "system_fingerprint": "fp_ollama",
+        "choices": [
+            {
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }
+        ]
+    }
+    if usage is not None:
+        event["usage"] = usage
+    return f"data: {dumps_json(event)}\n\n"
+
+class StreamRecorder:
+    """Saves the raw Venice streams of completed generations, with the delay
+    before each chunk, for fake_venice.py to replay.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, chunks, generation):
+        recorded = []
+        last_chunk_time = time.time()
+        for chunk in chunks:
+            now = time.time()
+            recorded.append({"delay": round(now - last_chunk_time, 4), "data": base64.b64encode(chunk).decode('ascii')})
+            last_chunk_time = now
+            yield chunk
+        if generation.complete and not generation.upstream_error:
+            self.save(generation, recorded)
+
+    def save(self, generation, chunks):
+        recording = {
+            "modelId": generation.api_data['modelId'],
+            "prompt": generation.api_data['prompt'],
+            "chunks": chunks
+        }
+        path = os.path.join(self.directory, f"{int(time.time())}-{generation.api_data['requestId']}.json")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(recording, f)
+        except OSError as e:
+            print(f"Could not save the recording {path}: {e}")
+
+def venice_content(chunks, generation):
+    if stream_recorder is not None:
+        chunks = stream_recorder.record(chunks, generation)
+    submit_time = generation.submitted_at = time.time()
+    first_chunk_time = None
+    for json_data in iter_ndjson(chunks):
+        if json_data.get('kind') == 'content' and len(json_data.get('content', '')) > 0:
+            if first_chunk_time is None:
+                first_chunk_time = generation.first_chunk_at = time.time()
+                STAGE_SECONDS.labels('first_chunk').observe(first_chunk_time - submit_time)
+            yield json_data['content']
+        elif json_data.get('kind') == 'error' or 'error' in json_data:
+            print(f"Venice reported an error:\n{json.dumps(json_data)}")
+            generation.fail(str(json_data.get('error') or json_data.get('content') or json_data))
+        elif len(json_data.get('content', '')) > 0:
+            print(f"Got an unknown message of kind {json_data.get('kind')}:\n{json.dumps(json_data)}")
+
+    if first_chunk_time is not None:
+        STAGE_SECONDS.labels('stream').observe(time.time() - first_chunk_time)
+
+def limit_content(contents, generation):
+    # Ends the content at the token limit or before the first stop
+    # sequence. Returning closes the upstream stream, which aborts the
+    # request to Venice and frees its session. Text that could be the start
+    # of a stop sequence split across pieces is held back until the next
+    # piece decides it, also after a match, as a longer stop sequence that
+    # starts earlier would win.
+    if generation.max_tokens is None and not generation.stop:
+        yield from contents
+        return
+
+    stops = generation.stop
+    prefixes = {stop[:length] for stop in stops for length in range(1, len(stop))}
+    longest_prefix = max((len(stop) for stop in stops), default=1) - 1
+    pending = ""
+    tokens = TokenCounter()
+
+    def first_stop(text):
+        return min((index for index in (text.find(stop) for stop in stops) if index >= 0), default=-1)
+
+    with closing(contents):
+        if generation.max_tokens == 0:
+            generation.stop_early('length')
+            return
+        for piece in contents:
+            # Cut first, so a stop sequence past the limit is not looked for
+            limited = False
+            if generation.max_tokens is not None:
+                piece, limited = tokens.take(piece, generation.max_tokens)
+            if stops:
+                text = pending + piece
+                found = first_stop(text)
+                held = 0 if limited else next((length for length in range(min(len(text), longest_prefix), 0, -1) if text[-length:] in prefixes), 0)
+                if 0 <= found <= len(text) - held:
+                    if found > 0:
+                        yield text[:found]
+                    generation.stop_early('stop')
+                    return
+                piece = text[:len(text) - held]
+                pending = text[len(text) - held:]
+            if piece:
+                yield piece
+            if limited:
+                generation.stop_early('length')
+                return
+        if pending:
+            found = first_stop(pending)
+            if found < 0:
+                yield pending
+                return
+            if found > 0:
+                yield pending[:found]
+            generation.stop_early('stop')
+
+def format_response(contents, generation, response_format):
+    # Formats the content pieces of a generation, streamed from Venice or
+    # replayed from the cache, in the shape the caller asked for.
+    model_id = generation.model_id
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    templates = MessageTemplates(response_format, model_id, completion_id, created)
+    ollama_stream = response_format in (ResponseFormat.CHAT, ResponseFormat.GENERATE)
+    first_content_at = None
+    # Kept for every format, the completion tokens are counted once at the end
+    streamed_pieces = []
+    with closing(contents):
+        for content in contents:
+            streamed_pieces.append(content)
+            if first_content_at is None:
+                first_content_at = time.time()
+                if response_format == ResponseFormat.OPENAI_STREAM:
+                    yield openai_stream_event(completion_id, created, model_id, {"role": "assistant", "content": content})
+                    continue
+
+            if ollama_stream:
+                yield templates.ollama(content)
+            elif response_format == ResponseFormat.OPENAI_STREAM:
+                yield templates.openai(content)
+    streamed_content = "".join(streamed_pieces)
+
+    done_reason = generation.done_reason or "stop"
+    eval_count = estimate_token_count(streamed_content)
+    prompt_eval_count = estimate_prompt_tokens(generation.messages)
+    if (response_format == ResponseFormat.CHAT) or (response_format == ResponseFormat.GENERATE) or (response_format == ResponseFormat.CHAT_NON_STREAMED):
+        # Queue wait and preparing the session count as loading, the wait
+        # for Venice's first content as prompt evaluation. Cache hits and
+        # coalesced requests did not send anything themselves and time
+        # their own first content.
+        finished_at = time.time()
+        submitted_at = generation.submitted_at or generation.admitted_at
+        first_chunk_at = generation.first_chunk_at or first_content_at or finished_at
+        first_chunk_at = min(max(first_chunk_at, submitted_at), finished_at)
+
+        final_message = {
+            "model": model_id,
+            "created_at": timestamps.now(),
+            # The streamed formats sent the content already
+            "message": {"role": "assistant", "content": "" if ollama_stream else streamed_content},
+            "done_reason": done_reason,
+            "done": True,
+            "total_duration": int((finished_at - generation.received_at) * 1e9),  # nanoseconds
+            "load_duration": int((submitted_at - generation.received_at) * 1e9),
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": int((first_chunk_at - submitted_at) * 1e9),
+            "eval_count": eval_count,
+            "eval_duration": int((finished_at - first_chunk_at) * 1e9)
+        }
+
+        yield dumps_json(final_message)
+    elif response_format == ResponseFormat.OPENAI_STREAM:
+        usage = {
+            "prompt_tokens": prompt_eval_count,
+            "completion_tokens": eval_count,
+            "total_tokens": prompt_eval_count + eval_count
+        }
+        yield openai_stream_event(completion_id, created, model_id, {}, finish_reason=done_reason, usage=usage)
+        yield "data: [DONE]\n\n"
+    elif response_format == ResponseFormat.OPENAI_NON_STREAMED:
+        response_json = {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model_id,
+            "system_fingerprint": "fp_ollama",
+            "choices": [
+                {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": streamed_content
+                },
+                "finish_reason": done_reason
                 }
-            """)
-            buffer = ""
-            for chunk in chunks:
-                last_data_time = time.time()
-                chunk_str = bytes(array.array('B', chunk)).decode('utf-8')
-                buffer += chunk_str
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)  # Split at the first newline
-                    if line:
-                        try:
-                            json_data = json.loads(line)
-                            if json_data.get('kind') == 'content' and len(json_data.get('content', '')) > 0:
-                                message = None
-                                eval_count += 1
-
-                                if response_format == ResponseFormat.CHAT:
-                                    message = {
-                                        "model": model_id,
-                                        "created_at": datetime.utcnow().isoformat() + "Z",
-                                        "message": {"role": "assistant", "content": json_data.get('content', '')},
-                                        "done": False
-                                    }
-                                    yield f"{json.dumps(message)}\r\n"
-                                elif response_format == ResponseFormat.CHAT_NON_STREAMED:
-                                    streamed_content += json_data.get('content', '')
-                                elif response_format == ResponseFormat.GENERATE:
-                                    message = {
-                                        "model": model_id,
-                                        "created_at": datetime.utcnow().isoformat() + "Z",
-                                        "response": json_data.get('content', ''),
-                                        "done": False
-                                    }
-                                    yield f"{json.dumps(message)}\r\n"
-                                elif response_format == ResponseFormat.COMPLETION_AS_STRING:
-                                    yield json_data.get('content', '')
-                            elif len(json_data.get('content', '')) > 0:
-                                print(f"Got an unknown message of kind {json_data.get('kind')}:\n{line}")
-                        except json.JSONDecodeError:
-                            print(f"Failed to parse line: {line}")
-
-            if driver.execute_script("return window.streamComplete;"):
-                break
-            if time.time() - last_data_time > timeout:
-                print(f"Timeout: No data received for {timeout} seconds. Exiting loop.")
-                break
-            time.sleep(0.1)
-
-        capture_and_redirect_browser_logs(driver)
-
-        if (response_format == ResponseFormat.CHAT) or (response_format == ResponseFormat.GENERATE) or (response_format == ResponseFormat.CHAT_NON_STREAMED):
-            end_time = datetime.now(timezone.utc)
-            duration = int((end_time - start_time).total_seconds() * 1e9)  # nanoseconds
-
-            final_message = {
-                "model": model_id,
-                "created_at": datetime.utcnow().isoformat() + "Z",
-                "message": {"role": "assistant", "content": streamed_content},
-                "done_reason": "stop",
-                "done": True,
-                "total_duration": duration,
-                "load_duration": duration,
-                "prompt_eval_count": eval_count,
-                "prompt_eval_duration": duration,
-                "eval_count": eval_count,
-                "eval_duration": duration
+            ],
+            "usage": {
+                "prompt_tokens": prompt_eval_count,
+                "completion_tokens": eval_count,
+                "total_tokens": prompt_eval_count + eval_count
+            }
             }
+        yield dumps_json(response_json)
+
+class GenerationStats:
+    """Counts completed generations and those cancelled because the client
+    disconnected. The upstream time a cancellation saves is estimated from
+    the average duration of completed generations.
+    """
 
-            yield f"{json.dumps(final_message)}"
+    def __init__(self):
+        self.completed = 0
+        self.completed_seconds = 0.0
+        self.cancelled = 0
+        self.seconds_saved = 0.0
+
+    def record_completed(self, seconds):
+        self.completed += 1
+        self.completed_seconds += seconds
+
+    def record_cancelled(self, seconds):
+        self.cancelled += 1
+        if self.completed:
+            self.seconds_saved += max(0.0, self.completed_seconds / self.completed - seconds)
+
+    def status(self):
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "seconds_saved_by_cancelling": round(self.seconds_saved, 3)
+        }
+
+generation_stats = GenerationStats()
+
+@contextmanager
+def cancel_on_disconnect(cancel, generation):
+    # Closing the response generator (the client hung up, or limit_content
+    # stopped early) raises GeneratorExit at the pending yield, which
+    # surfaces here.
+    start_time = time.time()
+    try:
+        yield
+    except GeneratorExit:
+        elapsed = time.time() - start_time
+        if generation.hedge_lost:
+            print(f"Another copy of the request answered first, cancelling this one after {elapsed:.1f} seconds")
+        elif generation.done_reason:
+            print(f"Stopped early ({generation.done_reason}) after {elapsed:.1f} seconds, cancelling the rest of the generation")
+        else:
+            print(f"Client disconnected after {elapsed:.1f} seconds, cancelling the generation")
+        try:
+            cancel()
+        except WebDriverException as e:
+            print(f"Error occurred while cancelling the generation: {e}")
+        # A lost hedge is counted by the hedge statistics, its duration would
+        # skew the averages the queue's Retry-After is estimated from
+        if generation.hedge_lost:
+            pass
+        elif generation.done_reason:
+            generation_stats.record_completed(elapsed)
+        else:
+            generation_stats.record_cancelled(elapsed)
+        raise
+    generation_stats.record_completed(time.time() - start_time)
+
+def stream_selenium_content(generation, session):
+    try:
+        with cancel_on_disconnect(lambda: session.driver.execute_script(ABORT_INTERCEPTED_REQUEST_SCRIPT), generation):
+            prepared, session.prepared = session.prepared, False
+            submit_chat_request(session.driver, generation.api_data, prepared)
+            yield from venice_content(intercepted_chunks(session.driver, generation), generation)
     except WebDriverException as e:
         print(f"Error occurred during chat: {e}")
+        raise
+
+def page_fetch_chunks(session, request_id, generation):
+    last_data_time = time.time()
+    while True:
+        chunks, done, status, error = session.collect_page_stream(request_id)
+        for chunk in chunks:
+            last_data_time = time.time()
+            yield chunk
+
+        if status in (401, 403):
+            raise VeniceAuthExpired(f"Venice answered {status}")
+        if done:
+            if status == 200 and not error:
+                generation.complete = True
+            elif error:
+                print(f"In-page request broke off: {error}")
+                generation.fail(error, status)
+            else:
+                print(f"In-page request failed with status {status}")
+                generation.fail(f"Venice answered {status}", status)
+            break
+        if time.time() - last_data_time > timeout:
+            print(f"Timeout: No data received for {timeout} seconds. Exiting loop.")
+            TIMEOUTS.inc()
+            session.driver.execute_script(ABORT_PAGE_FETCH_SCRIPT, request_id)
+            break
+
+    capture_and_redirect_browser_logs(session.driver)
+
+def stream_page_content(generation, session):
+    request_id = generation.api_data['requestId']
+    session.page_streams[request_id] = {"chunks": [], "done": False, "status": None, "error": None}
+    try:
+        if not session.driver.current_url.startswith(venice_url):
+            session.driver.get(f"{venice_url}/chat")
+        with cancel_on_disconnect(lambda: session.driver.execute_script(ABORT_PAGE_FETCH_SCRIPT, request_id), generation):
+            session.driver.execute_script(START_PAGE_FETCH_SCRIPT, request_id, generation.api_data)
+            yield from venice_content(page_fetch_chunks(session, request_id, generation), generation)
+    except WebDriverException as e:
+        print(f"Error occurred during chat: {e}")
+        raise
+    finally:
+        session.page_streams.pop(request_id, None)
+
+
+def stream_pooled_content(generation, lease):
+    if args.fetch_mode == 'page':
+        stream_session_content = stream_page_content
+    else:
+        stream_session_content = stream_selenium_content
+
+    for attempt in range(2):
+        if attempt > 0:
+            try:
+                lease = session_pool.checkout(lease.priority, lease.client)
+            except (QueueFull, QueueTimeout) as e:
+                print(f"Could not retry the request on another session: {e}")
+                return
+        session = lease.session
+        sent = False
         try:
-            driver.quit()
-        except WebDriverException as e:
-            print(f"Error occurred while quitting WebDriver: {e}")
+            with closing(stream_session_content(generation, session)) as contents:
+                for content in contents:
+                    sent = True
+                    yield content
+            session.account.record_generation(generation)
+            return
+        except (WebDriverException, VeniceAuthExpired) as e:
+            session.healthy = False
+            session.last_error = str(e)
+            if sent:
+                # The client already has part of this answer, a second one
+                # would be appended to it. The generation stays incomplete.
+                print(f"Session {session.id} failed in the middle of a response, ending it: {e}")
+                return
+        finally:
+            lease.release()
+
+
+class VeniceAuthExpired(Exception):
+    pass
+
+
+class VeniceHttpClient:
+    """Posts inference requests straight to Venice over a keep-alive
+    connection pool, authenticated with cookies borrowed from a logged-in
+    browser session.
+    """
 
-        driver = login_to_venice()
-        if driver:
-            yield from generate_selenium_streamed_response(data, driver, response_format)
+    pool_size = 32
+
+    def __init__(self):
+        self.url = f"{venice_url}/api/inference/chat"
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.http.mount('https://', adapter)
+        self.auth_lock = Semaphore()
+        self.auth_version = 0
+
+    def load_auth(self, driver):
+        self.http.cookies.clear()
+        for cookie in driver.get_cookies():
+            self.http.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        self.http.headers.update({
+            "User-Agent": driver.execute_script("return navigator.userAgent;"),
+            "Origin": venice_url,
+            "Referer": f"{venice_url}/chat"
+        })
+        self.auth_version += 1
+
+    def refresh_auth(self, seen_version, session):
+        # Only the first request to notice expired credentials reloads the
+        # page, the others wait for it and reuse the new cookies. Uses the
+        # session the request already holds a slot on, checking out another
+        # one could wait on requests that are themselves waiting for the lock.
+        with self.auth_lock:
+            if self.auth_version != seen_version:
+                return
+            if not session.healthy:
+                # An earlier refresh found the browser logged out as well
+                raise WebDriverException(f"Session {session.id} is waiting to log in again")
+            print("Venice rejected the session cookies, refreshing them from the browser")
+            session.driver.get(f"{venice_url}/chat")
+            ensure_logged_in(session.driver)
+            self.load_auth(session.driver)
+
+    def stream(self, generation):
+        try:
+            response = self.http.post(self.url, json=generation.api_data, stream=True, timeout=(selenium_timeout, timeout))
+        except requests.exceptions.RequestException as e:
+            print(f"Error occurred while posting to Venice: {e}")
+            return
+
+        with response:
+            if response.status_code in (401, 403):
+                raise VeniceAuthExpired(f"Venice answered {response.status_code}")
+            if not response.ok:
+                print(f"Venice answered {response.status_code}: {response.text[:200]}")
+                generation.fail(f"Venice answered {response.status_code}", response.status_code)
+                return
+            try:
+                yield from response.iter_content(chunk_size=None)
+                generation.complete = True
+            except requests.exceptions.RequestException as e:
+                print(f"Timeout: No data received for {timeout} seconds ({e}). Exiting loop.")
+                TIMEOUTS.inc()
+
+
+def stream_http_content(generation, lease):
+    try:
+        for attempt in range(2):
+            auth_version = venice_http.auth_version
+            chunks = venice_http.stream(generation)
+            try:
+                with cancel_on_disconnect(chunks.close, generation):
+                    yield from venice_content(chunks, generation)
+                lease.session.account.record_generation(generation)
+                return
+            except VeniceAuthExpired as e:
+                print(f"Error occurred during chat: {e}")
+                try:
+                    venice_http.refresh_auth(auth_version, lease.session)
+                except WebDriverException as e:
+                    # The browser was logged out too. Releasing the unhealthy
+                    # session has the pool log it in again.
+                    print(f"Session {lease.session.id} could not refresh the Venice cookies: {e.msg}")
+                    lease.session.healthy = False
+                    lease.session.last_error = str(e)
+                    generation.fail(f"Venice rejected the session cookies: {e.msg}")
+                    return
+    finally:
+        lease.release()
+
+
+class HedgePolicy:
+    """When to send a second copy of a request that is slow to start.
+
+    A request that has produced no content `after` seconds is sent once more
+    on another idle session (in the http fetch mode, as another request).
+    With a percentile, the wait is that percentile of the recent times to
+    first content instead, once min_samples of them have been seen. The
+    first copy to produce content is kept and the other one is aborted.
+    """
+
+    min_samples = 20
+
+    def __init__(self, after, percentile=None, window=200):
+        self.after = after
+        self.percentile = percentile
+        self.first_chunk_times = deque(maxlen=window)
+        self.launched = 0
+        self.won = 0
+        self.skipped = 0
+        self.seconds_saved = 0.0
+
+    def delay(self):
+        if self.percentile is None or len(self.first_chunk_times) < self.min_samples:
+            return self.after
+        ordered = sorted(self.first_chunk_times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def record_first_chunk(self, seconds):
+        self.first_chunk_times.append(seconds)
+
+    def status(self):
+        return {
+            "delay_seconds": round(self.delay(), 3),
+            "launched": self.launched,
+            "won": self.won,
+            "skipped_no_idle_session": self.skipped,
+            "seconds_saved": round(self.seconds_saved, 3)
+        }
+
+
+class HedgedAttempt:
+    """One copy of a hedged request. A greenlet waits for its first
+    content piece, so the copies can be raced against each other.
+    """
+
+    def __init__(self, generation, lease):
+        self.generation = generation
+        self.lease = lease
+        if args.fetch_mode == 'http':
+            self.contents = stream_http_content(generation, lease)
+        else:
+            self.contents = stream_pooled_content(generation, lease)
+        self.started = time.time()
+        self.first = None
+        self.error = None
+        self.finished = False
+        self.greenlet = None
+
+    def start(self, results):
+        self.greenlet = gevent.spawn(self._wait_first, results)
+
+    def _wait_first(self, results):
+        try:
+            self.first = next(self.contents, None)
+        except GeneratorExit:
+            return
+        except Exception as e:
+            self.error = e
+        self.finished = True
+        results.put(self)
+
+    def abort(self):
+        # GeneratorExit unwinds the stream like a client disconnect, which
+        # aborts the request to Venice
+        if not self.finished:
+            self.generation.hedge_lost = True
+            self.greenlet.kill(GeneratorExit)
+        self.contents.close()
+        self.lease.release()
+
+def launch_hedge(generation, lease):
+    # The http fetch mode only borrows the session's cookies, so the hedge
+    # may take another slot of the same session
+    exclude = None if args.fetch_mode == 'http' else lease.session
+    hedge_lease = session_pool.try_checkout(lease.priority, lease.client, exclude=exclude)
+    if hedge_lease is None:
+        return None
+    return HedgedAttempt(generation.hedge(), hedge_lease)
+
+def hedged_content(generation, lease):
+    # Every copy streams into a Generation of its own, the winner's outcome
+    # is copied over at the end
+    results = gevent.queue.Queue()
+    primary = HedgedAttempt(generation.hedge(generation.api_data['requestId']), lease)
+    primary.start(results)
+    attempts = [primary]
+    racing = 1
+    hedge_at = primary.started + hedge_policy.delay()
+    winner = None
+    try:
+        while winner is None and racing:
+            wait = max(0, hedge_at - time.time()) if len(attempts) == 1 and hedge_at else None
+            try:
+                attempt = results.get(timeout=wait)
+            except gevent.queue.Empty:
+                hedge = launch_hedge(generation, lease)
+                hedge_at = None
+                if hedge is None:
+                    hedge_policy.skipped += 1
+                    continue
+                print(f"No content after {hedge.started - primary.started:.1f} seconds, hedging the request")
+                hedge_policy.launched += 1
+                hedge.start(results)
+                attempts.append(hedge)
+                racing += 1
+                continue
+            racing -= 1
+            if attempt.first is not None:
+                winner = attempt
+
+        if winner is None:
+            # Every copy ended without content, report how the last one did
+            if attempt.error is not None:
+                raise attempt.error
+            winner = attempt
+        else:
+            hedge_policy.record_first_chunk(time.time() - winner.started)
+            generation.submitted_at = winner.generation.submitted_at
+            generation.first_chunk_at = winner.generation.first_chunk_at
+            if winner is not primary:
+                hedge_policy.won += 1
+                # The primary would have given up after --timeout seconds without data at the latest
+                hedge_policy.seconds_saved += max(0, primary.started + timeout - time.time())
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.abort()
+            with closing(winner.contents):
+                try:
+                    yield winner.first
+                    yield from winner.contents
+                except GeneratorExit:
+                    winner.generation.done_reason = generation.done_reason
+                    raise
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.abort()
+
+    generation.complete = winner.generation.complete
+    generation.upstream_error = winner.generation.upstream_error
+    generation.throttled = winner.generation.throttled
+
+
+# Request fields that only affect how the response is delivered
+DELIVERY_FIELDS = ('stream', 'keep_alive', 'stream_options')
+
+def request_key(data):
+    # Requests with the same key get the same generation from Venice
+    key_data = {name: value for name, value in data.items() if name not in DELIVERY_FIELDS}
+    key_data['model'] = (data.get('model') or '').split(':latest')[0]
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Completed generations keyed by a hash of the request, kept as their
+    content pieces so a hit can be replayed in any response format.
+
+    Entries live in an in-memory LRU and, when a directory is given, are
+    also written to disk so they survive restarts. Entries expire after ttl
+    seconds, and each store evicts its least recently used (on disk: oldest)
+    entries once it grows past its size limit.
+    """
+
+    def __init__(self, ttl, max_bytes, directory=None, disk_max_bytes=0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            files = []
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    stat = os.stat(os.path.join(directory, name))
+                    files.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+            for created, key, size in sorted(files):
+                self.disk_entries[key] = (created, size)
+                self.disk_size += size
+            self._trim_disk()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        now = time.time()
+        pieces = None
+        if key in self.entries:
+            created, size, cached_pieces = self.entries[key]
+            if now - created < self.ttl:
+                self.entries.move_to_end(key)
+                pieces = cached_pieces
+            else:
+                self._drop(key)
+        if pieces is None and key in self.disk_entries:
+            pieces = self._read(key, now)
+
+        CACHE_LOOKUPS.labels('miss' if pieces is None else 'hit').inc()
+        return pieces
+
+    def put(self, key, pieces, created=None):
+        created = created or time.time()
+        size = sum(len(piece.encode('utf-8')) for piece in pieces)
+        if key in self.entries:
+            self._drop(key)
+        if size <= self.max_bytes:
+            self.entries[key] = (created, size, pieces)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+        if self.directory and key not in self.disk_entries:
+            self._write(key, pieces, created)
+
+    def record(self, key, contents, generation):
+        # Passes the content through and stores it once Venice completed
+        # the stream. Disconnects and timeouts leave the cache untouched.
+        pieces = []
+        with closing(contents):
+            for content in contents:
+                pieces.append(content)
+                yield content
+        if generation.complete and not generation.upstream_error and pieces:
+            self.put(key, pieces)
+
+    def _drop(self, key):
+        created, size, pieces = self.entries.pop(key)
+        self.size -= size
+
+    def _read(self, key, now):
+        created, size = self.disk_entries[key]
+        try:
+            if now - created >= self.ttl:
+                raise ValueError("expired")
+            with open(self.path(key), encoding='utf-8') as f:
+                pieces = json.load(f)['pieces']
+        except (OSError, ValueError, KeyError):
+            self._remove_file(key)
+            return None
+        self.put(key, pieces, created)
+        return pieces
+
+    def _write(self, key, pieces, created):
+        path = self.path(key)
+        try:
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump({"pieces": pieces}, f)
+            os.utime(f"{path}.tmp", (created, created))
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"Could not write the cache entry {key}: {e}")
+            return
+        size = os.path.getsize(path)
+        self.disk_entries[key] = (created, size)
+        self.disk_size += size
+        self._trim_disk()
+
+    def _trim_disk(self):
+        now = time.time()
+        for key, (created, size) in list(self.disk_entries.items()):
+            if now - created < self.ttl and self.disk_size <= self.disk_max_bytes:
+                break
+            self._remove_file(key)
+
+    def _remove_file(self, key):
+        created, size = self.disk_entries.pop(key)
+        self.disk_size -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def status(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "disk_entries": len(self.disk_entries),
+            "disk_bytes": self.disk_size
+        }
+
+
+class SharedGeneration:
+    """A generation streamed once from Venice and fanned out to every
+    request with the same key that arrives while it runs.
+
+    Each subscriber formats the content pieces itself and starts from the
+    first piece, so a late joiner gets the prefix replayed. The generation
+    is cancelled once all of its subscribers have disconnected.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.admitted = AsyncResult()
+        self.pieces = []
+        self.done = False
+        self.subscribers = 0
+        self.changed = Event()
+
+    def start(self, contents, lease):
+        self.admitted.set(True)
+        gevent.spawn(self._pump, contents, lease)
+
+    def subscribe(self):
+        self.subscribers += 1
+        return self._follow()
+
+    def _follow(self):
+        position = 0
+        try:
+            while True:
+                changed = self.changed
+                while position < len(self.pieces):
+                    yield self.pieces[position]
+                    position += 1
+                if self.done:
+                    return
+                changed.wait()
+        finally:
+            self.subscribers -= 1
+
+    def _notify(self):
+        changed, self.changed = self.changed, Event()
+        changed.set()
+
+    def _pump(self, contents, lease):
+        try:
+            with closing(contents):
+                for content in contents:
+                    self.pieces.append(content)
+                    self._notify()
+                    if self.subscribers == 0:
+                        break
+        except Exception as e:
+            print(f"Error occurred during a shared generation: {e}")
+        finally:
+            self.done = True
+            shared_generations.pop(self.key, None)
+            self._notify()
+            if lease is not None:
+                lease.release()
+
+shared_generations = {}
+
+
+def request_priority(request_json):
+    priority = request.headers.get('X-Priority') or model_priorities.get((request_json.get('model') or '').split(':latest')[0], 'normal')
+    return PRIORITY_CLASSES.get(priority.lower(), PRIORITY_CLASSES['normal'])
+
+def request_client():
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+def admit_request(request_json):
+    # Reserves a session slot before the response starts, so a full queue
+    # can still be answered with an error status. In the http fetch mode a
+    # slot stands for one request sent with the session's cookies, which are
+    # only usable once they are loaded.
+    if args.fetch_mode == 'http' and not server_ready.wait(args.max_queue_wait):
+        raise QueueTimeout(f"Venice session was not ready within {args.max_queue_wait} seconds")
+    return session_pool.checkout(request_priority(request_json), request_client())
+
+def queue_error_response(error):
+    status = 429 if isinstance(error, QueueFull) else 503
+    retry_after = circuit_breaker.retry_after() if isinstance(error, CircuitOpen) else session_pool.retry_after()
+    return Response(str(error), status=status, content_type='text/plain', headers={"Retry-After": str(retry_after)})
+
+def start_response(data, response_format):
+    # Returns the formatted response and the session lease it holds, or no
+    # lease for cache hits and coalesced requests.
+    # Raises QueueFull or QueueTimeout when the request is not admitted.
+    received_at = time.time()
+    REQUESTS.labels(route=request.path, model=model_catalog.metric_label(data.get('model')), format=response_format.name.lower()).inc()
+
+    key = request_key(data)
+    cache_control = request.headers.get('Cache-Control', '')
+    fresh = 'no-cache' in cache_control
+    if response_cache is not None and not fresh:
+        pieces = response_cache.get(key)
+        if pieces is not None:
+            generation = Generation(data, received_at)
+            return format_response(limit_content((piece for piece in pieces), generation), generation, response_format), None
+
+    shared = None
+    if args.coalesce and not fresh:
+        shared = shared_generations.get(key)
+        if shared is not None:
+            # Fails the same way as the request that started the generation
+            shared.admitted.get()
+            COALESCED.inc()
+            generation = Generation(data, received_at)
+            return format_response(limit_content(shared.subscribe(), generation), generation, response_format), None
+        shared = shared_generations[key] = SharedGeneration(key)
+
+    try:
+        circuit_breaker.allow()
+        lease = admit_request(data)
+    except (QueueFull, QueueTimeout, CircuitOpen) as e:
+        if not isinstance(e, CircuitOpen):
+            circuit_breaker.abandon()
+        if shared is not None:
+            del shared_generations[key]
+            shared.admitted.set_exception(e)
+        raise
+    generation = Generation(data, received_at)
+    if hedge_policy is not None:
+        contents = hedged_content(generation, lease)
+    elif args.fetch_mode == 'http':
+        contents = stream_http_content(generation, lease)
+    else:
+        contents = stream_pooled_content(generation, lease)
+    contents = limit_content(contents, generation)
+    contents = circuit_breaker.watch(contents, generation)
+    if response_cache is not None and 'no-store' not in cache_control:
+        contents = response_cache.record(key, contents, generation)
+
+    if shared is not None:
+        subscription = shared.subscribe()
+        shared.start(contents, lease)
+        return format_response(subscription, generation, response_format), None
+    return format_response(contents, generation, response_format), lease
+
+def streamed_response(response_stream, lease, content_type, headers=None):
+    response = Response(response_stream, content_type=content_type, headers=headers)
+    if lease is not None:
+        # The generator releases the lease itself, unless it is never started
+        response.call_on_close(lease.release)
+    return response
 
 
 def parse_json_request(request):
@@ -728,10 +2775,11 @@ def parse_json_request(request):
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    global driver
     request_json = parse_json_request(request)
     if request_json is None :
             return Response("Invalid JSON data received", status=400, content_type='text/plain')
+    if not model_catalog.knows(request_json.get('model')):
+        return model_not_found_response(request_json.get('model'))
 
     response_format = ResponseFormat.CHAT
     content_type = 'application/x-ndjson'
@@ -740,15 +2788,19 @@ def chat():
         response_format = ResponseFormat.CHAT_NON_STREAMED
         content_type = 'application/json; charset=utf-8'
 
-    with selenium_lock:
-        return Response(generate_selenium_streamed_response(request_json, driver, response_format=response_format), content_type=content_type)
+    try:
+        response_stream, lease = start_response(request_json, response_format)
+    except (QueueFull, QueueTimeout, CircuitOpen) as e:
+        return queue_error_response(e)
+    return streamed_response(response_stream, lease, content_type)
 
 @app.route('/api/generate', methods=['POST'])
 def generate():
-    global driver
     request_json = parse_json_request(request)
     if request_json is None :
         return Response("Invalid JSON data received", status=400, content_type='text/plain')
+    if not model_catalog.knows(request_json.get('model')):
+        return model_not_found_response(request_json.get('model'))
 
     prompt = request_json.pop('prompt')
 
@@ -775,36 +2827,133 @@ def generate():
                 "content": prompt
             }
         ]
-    with selenium_lock:
-        return Response(generate_selenium_streamed_response(request_json, driver, response_format=ResponseFormat.GENERATE), content_type='application/x-ndjson')
+    try:
+        response_stream, lease = start_response(request_json, ResponseFormat.GENERATE)
+    except (QueueFull, QueueTimeout, CircuitOpen) as e:
+        return queue_error_response(e)
+    return streamed_response(response_stream, lease, 'application/x-ndjson')
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def openai_like_completion():
     request_json = parse_json_request(request)
-    completion = ''.join(generate_selenium_streamed_response(request_json, driver, response_format=ResponseFormat.COMPLETION_AS_STRING))
-    response_json = {
-        "id": "chatcmpl-953",
-        "object": "chat.completion",
-        "created": int(datetime.now().timestamp()),
-        "model": request_json["model"],
-        "system_fingerprint": "fp_ollama",
-        "choices": [
-            {
-            "index": 0,
-            "message": {
-                "role": "assistant",
-                "content": completion
-            },
-            "finish_reason": "stop"
-            }
-        ]
-        }
-    return Response(json.dumps(response_json), mimetype='application/json')
-
-
-
+    if request_json is None :
+        return Response("Invalid JSON data received", status=400, content_type='text/plain')
+    if not model_catalog.knows(request_json.get('model')):
+        return model_not_found_response(request_json.get('model'))
 
+    response_format = ResponseFormat.OPENAI_STREAM if request_json.get('stream') else ResponseFormat.OPENAI_NON_STREAMED
+    try:
+        response_stream, lease = start_response(request_json, response_format)
+    except (QueueFull, QueueTimeout, CircuitOpen) as e:
+        return queue_error_response(e)
+
+    if request_json.get('stream'):
+        return streamed_response(response_stream, lease, 'text/event-stream', headers={"Cache-Control": "no-cache"})
+    return streamed_response(response_stream, lease, 'application/json')
+
+
+
+
+
+
+@app.route('/api/sessions', methods=['GET'])
+def sessions():
+    return Response(json.dumps({"sessions": session_pool.status(), "accounts": [account.status() for account in session_pool.accounts],
+                                "queue": session_pool.queue.status(), "generations": generation_stats.status(),
+                                "cache": response_cache.status() if response_cache is not None else None,
+                                "hedging": hedge_policy.status() if hedge_policy is not None else None,
+                                "models": model_catalog.status()}), content_type='application/json')
+
+class ServerStateCollector:
+    """Exports session, queue and generation state when /metrics is scraped."""
+
+    def collect(self):
+        sessions = GaugeMetricFamily('venice_sessions', 'Browser sessions by state', labels=['state'])
+        states = [session.status()['state'] for session in session_pool.sessions]
+        for state in ('idle', 'busy', 'starting', 'broken'):
+            sessions.add_metric([state], states.count(state))
+        yield sessions
+        yield GaugeMetricFamily('venice_active_requests', 'Requests currently holding a session slot',
+                                value=sum(session.active for session in session_pool.sessions))
+        rss = GaugeMetricFamily('venice_browser_rss_bytes', 'Resident memory of each session\'s browser at the last watchdog check', labels=['session'])
+        for session in session_pool.sessions:
+            if session.rss_bytes is not None:
+                rss.add_metric([str(session.id)], session.rss_bytes)
+        yield rss
+
+        account_active = GaugeMetricFamily('venice_account_active_requests', 'Requests currently served by each account', labels=['account'])
+        account_cooling = GaugeMetricFamily('venice_account_cooling_down', 'Whether an account is taken out of rotation after throttling or errors', labels=['account'])
+        for account in session_pool.accounts:
+            account_active.add_metric([account.name], account.active)
+            account_cooling.add_metric([account.name], 1 if account.cooling_until > time.time() else 0)
+        yield account_active
+        yield account_cooling
+
+        queue = session_pool.queue.status()
+        depth = GaugeMetricFamily('venice_queue_depth', 'Requests waiting for a free session', labels=['priority'])
+        for priority, count in queue['depth_by_priority'].items():
+            depth.add_metric([priority], count)
+        yield depth
+        yield CounterMetricFamily('venice_queue_rejected', 'Requests rejected with 429 because the queue was full', value=queue['rejected'])
+        yield CounterMetricFamily('venice_queue_timed_out', 'Requests answered 503 after waiting --max-queue-wait seconds', value=queue['timed_out'])
+
+        yield CounterMetricFamily('venice_generations_completed', 'Generations streamed to the end', value=generation_stats.completed)
+        yield CounterMetricFamily('venice_generations_cancelled', 'Generations aborted because the client disconnected', value=generation_stats.cancelled)
+        yield CounterMetricFamily('venice_cancelled_seconds_saved', 'Estimated upstream seconds saved by aborting cancelled generations', value=generation_stats.seconds_saved)
+
+        if hedge_policy is not None:
+            yield CounterMetricFamily('venice_hedges_launched', 'Requests sent a second time because they produced no content in time', value=hedge_policy.launched)
+            yield CounterMetricFamily('venice_hedges_won', 'Hedged requests where the second copy produced content first', value=hedge_policy.won)
+            yield CounterMetricFamily('venice_hedges_skipped', 'Hedges not sent because no other session was idle', value=hedge_policy.skipped)
+            yield CounterMetricFamily('venice_hedge_seconds_saved', 'Upper bound of the waiting saved by hedges that won', value=hedge_policy.seconds_saved)
+
+        breaker = GaugeMetricFamily('venice_circuit_breaker_state', 'Circuit breaker state, 1 for the current one', labels=['state'])
+        for state in ('closed', 'open', 'half_open'):
+            breaker.add_metric([state], 1 if circuit_breaker.state == state else 0)
+        yield breaker
+
+        if response_cache is not None:
+            cache = response_cache.status()
+            entries = GaugeMetricFamily('venice_cache_entries', 'Cached responses by store', labels=['store'])
+            entries.add_metric(['memory'], cache['entries'])
+            entries.add_metric(['disk'], cache['disk_entries'])
+            yield entries
+            size = GaugeMetricFamily('venice_cache_bytes', 'Size of the cached responses by store', labels=['store'])
+            size.add_metric(['memory'], cache['bytes'])
+            size.add_metric(['disk'], cache['disk_bytes'])
+            yield size
+
+def warm_up():
+    session_pool.start()
+    gevent.spawn(session_pool.watch)
+    if args.fetch_mode == 'http':
+        with session_pool.session() as session:
+            venice_http.load_auth(session.driver)
+    server_ready.set()
+    print("Ready to serve requests")
+
+@app.route('/health', methods=['GET'])
+def health():
+    # Readiness probe: the port is bound before the sessions have logged in
+    healthy_sessions = sum(1 for session in session_pool.sessions if session.healthy)
+    ready = server_ready.is_set() and healthy_sessions > 0
+    if not ready:
+        status = "starting"
+    elif circuit_breaker.state == "closed":
+        status = "ready"
+    else:
+        status = "degraded"
+    health_response = {
+        "status": status,
+        "healthy_sessions": healthy_sessions,
+        "sessions": len(session_pool.sessions),
+        "circuit_breaker": circuit_breaker.status()
+    }
+    return Response(json.dumps(health_response), status=200 if status == "ready" else 503, content_type='application/json')
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
 @app.route('/api/version', methods=['GET'])
 def version():
@@ -827,21 +2976,24 @@ def get_mock_model(name, parameter_size):
       }
     }
 
-@app.route('/api/tags', methods=['GET'])
-def tags():
-    tags_response = {
-        "models": [
-            get_mock_model("llama-3.1-405b-akash-api:latest", "405B"),
-            get_mock_model("dolphin-2.9.2-qwen2-72b:latest","72B"),
-            get_mock_model("llama-3.2-3b-akash:latest", "3B"),
-            get_mock_model("llama-3.1-nemotron-70b:latest", "70B"),
-            get_mock_model("nous-theta-web:latest", "8B"),
-            get_mock_model("nous-hermes3a-web:latest", "8B")
-        ]}
-    return Response(json.dumps(tags_response), content_type='application/json')
+# Used by requests that do not name a model, while Venice lists it
+DEFAULT_MODEL = "llama-3.1-405b-akash-api"
 
-@app.route('/api/show', methods=['POST'])
-def mock_show():
+# Venice serves its API from a subdomain, --venice-url servers such as
+# fake_venice.py from the same origin
+VENICE_MODELS_URL = 'https://api.venice.ai/api/v1/models'
+
+# Served until the catalog has been loaded, and when it cannot be
+BUILTIN_MODELS = [
+    {"id": "llama-3.1-405b-akash-api", "parameter_size": "405B"},
+    {"id": "dolphin-2.9.2-qwen2-72b", "parameter_size": "72B"},
+    {"id": "llama-3.2-3b-akash", "parameter_size": "3B"},
+    {"id": "llama-3.1-nemotron-70b", "parameter_size": "70B"},
+    {"id": "nous-theta-web", "parameter_size": "8B"},
+    {"id": "nous-hermes3a-web", "parameter_size": "8B"}
+]
+
+def get_mock_show(parameter_size, context_length=None):
     show_response = {
         "modelfile": "# Modelfile generated by \"ollama show\"\n# To build a new Modelfile based on this one, replace the FROM line with:\n# FROM llava:latest\n\nFROM /Users/matt/.ollama/models/blobs/sha256:200765e1283640ffbd013184bf496e261032fa75b99498a9613be4e94d63ad52\nTEMPLATE \"\"\"{{ .System }}\nUSER: {{ .Prompt }}\nASSISTANT: \"\"\"\nPARAMETER num_ctx 4096\nPARAMETER stop \"\u003c/s\u003e\"\nPARAMETER stop \"USER:\"\nPARAMETER stop \"ASSISTANT:\"",
         "parameters": "num_keep                       24\nstop                           \"<|start_header_id|>\"\nstop                           \"<|end_header_id|>\"\nstop                           \"<|eot_id|>\"",
@@ -853,7 +3005,7 @@ def mock_show():
             "families": [
             "llama"
             ],
-            "parameter_size": "8.0B",
+            "parameter_size": parameter_size,
             "quantization_level": "Q4_0"
         },
         "model_info": {
@@ -865,7 +3017,7 @@ def mock_show():
             "llama.attention.head_count_kv": 8,
             "llama.attention.layer_norm_rms_epsilon": 0.00001,
             "llama.block_count": 32,
-            "llama.context_length": 8192,
+            "llama.context_length": context_length or 8192,
             "llama.embedding_length": 4096,
             "llama.feed_forward_length": 14336,
             "llama.rope.dimension_count": 128,
@@ -882,41 +3034,247 @@ def mock_show():
         }
     return show_response
 
+
+class ModelCatalog:
+    """The models Venice offers, loaded from --models-file or fetched from
+    --models-url and refreshed in the background every ttl seconds.
+
+    The /api/tags and /api/show responses are serialized once per refresh.
+    Until a list has been loaded the built-in one is served and every model
+    name is accepted; afterwards requests for unknown models are rejected
+    before they reach Venice.
+    """
+
+    retry_delay = 60
+
+    def __init__(self, url=None, path=None, ttl=3600):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.loaded_at = None
+        self.authoritative = False
+        self._build(BUILTIN_MODELS)
+
+    def start(self):
+        self.refresh()
+        gevent.spawn(self._refresh_periodically)
+
+    def _refresh_periodically(self):
+        while True:
+            gevent.sleep(self.ttl if self.authoritative else min(self.ttl, self.retry_delay))
+            self.refresh()
+
+    def refresh(self):
+        try:
+            if self.path:
+                with open(self.path, encoding='utf-8') as f:
+                    listing = json.load(f)
+            else:
+                response = requests.get(self.url, timeout=selenium_timeout)
+                response.raise_for_status()
+                listing = response.json()
+            models = self._parse(listing)
+        except (OSError, ValueError, requests.exceptions.RequestException) as e:
+            print(f"Could not load the model list, serving the {'previous' if self.authoritative else 'built-in'} one: {e}")
+            return
+        if not models:
+            print("The model list is empty, keeping the current one")
+            return
+        self._build(models)
+        self.authoritative = True
+        self.loaded_at = time.time()
+        print(f"Loaded {len(models)} models")
+
+    def _parse(self, listing):
+        # Accepts a list of ids or model objects, bare or wrapped in "data"
+        # (the Venice API) or "models"
+        if isinstance(listing, dict):
+            listing = listing.get('data', listing.get('models', []))
+        models = []
+        for item in listing:
+            if isinstance(item, str):
+                models.append({"id": item})
+                continue
+            if item.get('type', 'text') != 'text':
+                continue
+            model_id = item.get('id') or item.get('modelId') or item.get('name')
+            if model_id:
+                models.append({
+                    "id": model_id.split(':latest')[0],
+                    "parameter_size": item.get('parameter_size', ''),
+                    "context_length": item.get('context_length') or item.get('model_spec', {}).get('availableContextTokens')
+                })
+        return models
+
+    def _build(self, models):
+        self.models = {model['id']: model for model in models}
+        self.tags_json = json.dumps({"models": [get_mock_model(f"{model['id']}:latest", model.get('parameter_size', '')) for model in models]}).encode('utf-8')
+        self.show_json = {model['id']: json.dumps(get_mock_show(model.get('parameter_size', ''), model.get('context_length'))).encode('utf-8') for model in models}
+
+    def knows(self, name):
+        return not self.authoritative or not name or name.split(':latest')[0] in self.models
+
+    def default_model(self):
+        # Falls back to the first listed model once Venice stops offering
+        # DEFAULT_MODEL, instead of sending requests that would be rejected
+        return DEFAULT_MODEL if DEFAULT_MODEL in self.models else next(iter(self.models))
+
+    def metric_label(self, name):
+        # Client supplied names would give the metrics unbounded label values
+        model_id = (name or '').split(':latest')[0]
+        return model_id if model_id in self.models else "other"
+
+    def show(self, name):
+        model_id = (name or '').split(':latest')[0]
+        if model_id in self.show_json:
+            return self.show_json[model_id]
+        if self.authoritative:
+            return None
+        return json.dumps(get_mock_show('')).encode('utf-8')
+
+    def status(self):
+        return {
+            "models": len(self.models),
+            "source": (self.path or self.url) if self.authoritative else "built-in",
+            "loaded_at": self.loaded_at
+        }
+
+
+def model_not_found_response(name):
+    return Response(json.dumps({"error": f"model \"{name}\" not found"}), status=404, content_type='application/json')
+
+@app.route('/api/tags', methods=['GET'])
+def tags():
+    return Response(model_catalog.tags_json, content_type='application/json')
+
+@app.route('/api/show', methods=['POST'])
+def show():
+    request_json = parse_json_request(request) or {}
+    name = request_json.get('model') or request_json.get('name')
+    show_response = model_catalog.show(name)
+    if show_response is None:
+        return model_not_found_response(name)
+    return Response(show_response, content_type='application/json')
+
 ## main code
 
-parser = argparse.ArgumentParser(description='Ollama-like API for venice.ai')
-
-parser.add_argument('--username', type=str, required=False, help='Venice username')
-parser.add_argument('--password', type=str, required=False, help='Venice password')
-
-# Optional arguments with defaults
-parser.add_argument('--host', type=str, default='127.0.0.1', help='Local host address')
-parser.add_argument('--port', type=int, default=9999, help='Server port')
-parser.add_argument('--timeout', type=int, default=20, help='Timeout for generating tokens from Venice (seconds)')
-parser.add_argument('--selenium-timeout', type=int, default=20, help='Selenium timeout (seconds)')
-parser.add_argument('--headless', action='store_true', default=True, help='Run Selenium in headless mode')
-parser.add_argument('--no-headless', action='store_false', dest='headless', help='Disable headless mode and run with a visible browser window')
-parser.add_argument('--debug-browser', action='store_true', default=False, help='Enable browser debugging logs')
-parser.add_argument('--docker', action='store_true', default=False, help='Do not run Chrome sandbox (required for docker)')
-parser.add_argument('--seed', type=str, required=False, help='Seed to log in with WalletConnect')
-parser.add_argument('--ensure-pro', action='store_true', default=False, help='Ensure that Venice recognized the user has a pro account')
-
-args = parser.parse_args()
-
-# Set username and password or seed from environment variables if not provided
-username = args.username or os.getenv('VENICE_USERNAME')
-password = args.password or os.getenv('VENICE_PASSWORD')
-seed = args.seed or os.getenv('VENICE_SEED')
-
-if (not seed) and (not username or not password):
-    print("Either seed or both username and password for venice are required. Set using command line arguments or environment variables - VENICE_SEED or VENICE_USERNAME and VENICE_PASSWORD", file=sys.stderr)
-    sys.exit(1)
-
-timeout=args.timeout
-selenium_timeout=args.selenium_timeout
-debug_browser = args.debug_browser
-
-driver = login_to_venice()
-print(f"Starting server at port {args.host}:{args.port}")
-http_server = WSGIServer((args.host, args.port), app)
-http_server.serve_forever()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ollama-like API for venice.ai')
+
+    parser.add_argument('--username', type=str, required=False, help='Venice username')
+    parser.add_argument('--password', type=str, required=False, help='Venice password')
+
+    # Optional arguments with defaults
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Local host address')
+    parser.add_argument('--port', type=int, default=9999, help='Server port')
+    parser.add_argument('--timeout', type=int, default=20, help='Timeout for generating tokens from Venice (seconds)')
+    parser.add_argument('--selenium-timeout', type=int, default=20, help='Selenium timeout (seconds)')
+    parser.add_argument('--headless', action='store_true', default=True, help='Run Selenium in headless mode')
+    parser.add_argument('--no-headless', action='store_false', dest='headless', help='Disable headless mode and run with a visible browser window')
+    parser.add_argument('--debug-browser', action='store_true', default=False, help='Enable browser debugging logs')
+    parser.add_argument('--docker', action='store_true', default=False, help='Do not run Chrome sandbox (required for docker)')
+    parser.add_argument('--seed', type=str, required=False, help='Seed to log in with WalletConnect')
+    parser.add_argument('--ensure-pro', action='store_true', default=False, help='Ensure that Venice recognized the user has a pro account')
+    parser.add_argument('--sessions', type=int, default=1, help='Number of logged-in browser sessions serving requests concurrently, per account')
+    parser.add_argument('--accounts', type=str, default=None, help='JSON file with a list of Venice accounts to spread requests over, see the README. Also read from the VENICE_ACCOUNTS environment variable')
+    parser.add_argument('--account-rpm', type=float, default=0, help='Requests per minute each account may send, 0 for no limit')
+    parser.add_argument('--account-burst', type=int, default=0, help='Requests an account may send at once before --account-rpm applies, defaults to a minute worth of requests')
+    parser.add_argument('--account-cooldown', type=int, default=60, help='Seconds a throttled account gets no requests, doubled each time it is throttled again')
+    parser.add_argument('--fetch-mode', choices=['ui', 'page', 'http'], default='ui', help='How requests reach Venice: "ui" drives the chat page, "page" fetches from inside the logged-in tab, "http" posts directly using the browser session cookies')
+    parser.add_argument('--prewarm', action='store_true', default=False, help='In the ui fetch mode, open a fresh conversation ready for the next request as soon as a session is released')
+    parser.add_argument('--requests-per-session', type=int, default=1, help='Concurrent requests per browser tab in the page fetch mode')
+    parser.add_argument('--http-slots', type=int, default=VeniceHttpClient.pool_size, help="Concurrent requests per session's cookies in the http fetch mode")
+    parser.add_argument('--max-queue', type=int, default=64, help='Requests allowed to wait for a free session before new ones get 429')
+    parser.add_argument('--max-queue-wait', type=int, default=120, help='Seconds a request may wait for a free session before it gets 503')
+    parser.add_argument('--profile-dir', type=str, default=os.getenv('VENICE_PROFILE_DIR'), help='Directory to keep the Chrome profiles of the sessions in, so a restart can reuse their login')
+    parser.add_argument('--cache', action='store_true', default=False, help='Cache completed responses and replay them for identical requests')
+    parser.add_argument('--cache-ttl', type=int, default=3600, help='Seconds a cached response is replayed for')
+    parser.add_argument('--cache-size', type=int, default=64, help='Memory for cached responses (MB)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory to also store cached responses in, so they survive restarts')
+    parser.add_argument('--cache-disk-size', type=int, default=1024, help='Disk space for cached responses in --cache-dir (MB)')
+    parser.add_argument('--coalesce', action='store_true', default=False, help='Serve identical concurrent requests from a single generation')
+    parser.add_argument('--block-resources', action='store_true', default=False, help='Do not load images, fonts, media and analytics in the browser sessions')
+    parser.add_argument('--block-url', action='append', default=[], metavar='PATTERN', help='Additional URL pattern (with * wildcards) the browser sessions should not load, can be repeated')
+    parser.add_argument('--venice-url', type=str, default='https://venice.ai', help='Base URL of Venice, e.g. a local fake_venice.py server')
+    parser.add_argument('--record-dir', type=str, default=None, help='Directory to save the raw Venice streams of completed generations in, for fake_venice.py to replay')
+    parser.add_argument('--hedge-after', type=float, default=0, help='Send a request again on another idle session when it produced no content after this many seconds, 0 disables')
+    parser.add_argument('--hedge-percentile', type=float, default=None, help='Hedge after this percentile of the recent times to first content instead, with --hedge-after until enough were seen')
+    parser.add_argument('--watchdog-interval', type=int, default=30, help='Seconds between checks of the browser sessions for recycling')
+    parser.add_argument('--recycle-tab-after', type=int, default=100, help='Reload the chat tab of a session after this many requests, 0 disables')
+    parser.add_argument('--recycle-session-after', type=int, default=0, help='Replace a session with a fresh login after this many requests, 0 disables')
+    parser.add_argument('--recycle-memory', type=int, default=0, help='Replace a session whose browser uses more memory than this (MB), 0 disables')
+    parser.add_argument('--breaker-threshold', type=int, default=5, help='Consecutive failed generations or logins after which requests fail fast with 503')
+    parser.add_argument('--breaker-cooldown', type=int, default=30, help='Seconds before a trial request is sent to Venice again, doubled after each failed trial')
+    parser.add_argument('--models-url', type=str, default=None, help='Venice model list served by /api/tags and used to reject unknown models, defaults to the one of --venice-url')
+    parser.add_argument('--models-file', type=str, default=None, help='JSON file with the model list, used instead of --models-url')
+    parser.add_argument('--models-ttl', type=int, default=3600, help='Seconds between refreshes of the model list')
+    parser.add_argument('--model-priority', action='append', default=[], metavar='MODEL=CLASS', help='Queue priority class (high, normal, low) for a model, can be repeated. The X-Priority header overrides it')
+
+    args = parser.parse_args()
+
+    # Set username and password or seed from environment variables if not provided
+    username = args.username or os.getenv('VENICE_USERNAME')
+    password = args.password or os.getenv('VENICE_PASSWORD')
+    seed = args.seed or os.getenv('VENICE_SEED')
+
+    accounts_json = None
+    if args.accounts:
+        with open(args.accounts, encoding='utf-8') as f:
+            accounts_json = json.load(f)
+    elif os.getenv('VENICE_ACCOUNTS'):
+        accounts_json = json.loads(os.getenv('VENICE_ACCOUNTS'))
+
+    if accounts_json is not None:
+        try:
+            accounts = load_accounts(accounts_json, sessions=args.sessions, requests_per_minute=args.account_rpm,
+                                     burst=args.account_burst, cooldown=args.account_cooldown)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if args.fetch_mode == 'http' and len(accounts) > 1:
+            # Every request would go out with the cookies of whichever
+            # account refreshed them last
+            print("The http fetch mode sends all requests with the cookies of one account, use the ui or page fetch mode with several accounts", file=sys.stderr)
+            sys.exit(1)
+    elif (not seed) and (not username or not password):
+        print("Either seed or both username and password for venice are required. Set using command line arguments or environment variables - VENICE_SEED or VENICE_USERNAME and VENICE_PASSWORD", file=sys.stderr)
+        sys.exit(1)
+    else:
+        accounts = [Account('default', username, password, seed, sessions=args.sessions, requests_per_minute=args.account_rpm,
+                            burst=args.account_burst, cooldown=args.account_cooldown)]
+
+    timeout=args.timeout
+    selenium_timeout=args.selenium_timeout
+    debug_browser = args.debug_browser
+    venice_url = args.venice_url.rstrip('/')
+    blocked_urls = (BLOCKED_RESOURCE_PATTERNS if args.block_resources else []) + args.block_url
+    stream_recorder = StreamRecorder(args.record_dir) if args.record_dir else None
+
+    circuit_breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown)
+    hedge_policy = HedgePolicy(args.hedge_after, args.hedge_percentile) if args.hedge_after > 0 else None
+    model_priorities = dict(option.split('=', 1) for option in args.model_priority)
+
+    slots = {'page': args.requests_per_session, 'http': args.http_slots}.get(args.fetch_mode, 1)
+    session_pool = SessionPool(accounts, slots=slots,
+                               max_queue=args.max_queue, max_wait=args.max_queue_wait, profile_dir=args.profile_dir,
+                               watchdog_interval=args.watchdog_interval, recycle_tab_after=args.recycle_tab_after,
+                               recycle_session_after=args.recycle_session_after, recycle_memory=args.recycle_memory * 1024 * 1024,
+                               prewarm=args.prewarm and args.fetch_mode == 'ui')
+    response_cache = None
+    if args.cache:
+        response_cache = ResponseCache(args.cache_ttl, args.cache_size * 1024 * 1024,
+                                       directory=args.cache_dir, disk_max_bytes=args.cache_disk_size * 1024 * 1024)
+    models_url = args.models_url or (VENICE_MODELS_URL if venice_url == 'https://venice.ai' else f"{venice_url}/api/v1/models")
+    model_catalog = ModelCatalog(url=models_url, path=args.models_file, ttl=args.models_ttl)
+    REGISTRY.register(ServerStateCollector())
+    if args.fetch_mode == 'http':
+        venice_http = VeniceHttpClient()
+
+    # Bind the port right away, requests wait in the queue while the
+    # sessions log in and /health answers 503 until one is ready.
+    print(f"Starting server at port {args.host}:{args.port}")
+    http_server = WSGIServer((args.host, args.port), app)
+    http_server.start()
+    gevent.spawn(model_catalog.start)
+    gevent.spawn(warm_up)
+    http_server.serve_forever()
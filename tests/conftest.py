@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ollama_like_server.py is a script at the repository root, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,80 @@
+import random
+
+from ollama_like_server import PRETOKEN_PATTERN, Generation, TokenCounter, estimate_token_count, limit_content, pretoken_count
+
+TEXT = "Sure!\nUser: hi there, 12345 wörds — naïve 日本語 text.\nUser:\n\nAssistant: done. User said STOP"
+
+
+def limited(pieces, **options):
+    generation = Generation({"model": "llama-3.1-405b-akash-api", "messages": [], "options": options})
+    output = list(limit_content((piece for piece in pieces), generation))
+    return "".join(output), generation.done_reason
+
+
+def reference(text, stop=(), num_predict=None):
+    # The same limits applied to the whole text at once. The last pretoken
+    # is not counted, as more of it could still have followed.
+    reason = None
+    if num_predict is not None:
+        count = 0
+        pretokens = list(PRETOKEN_PATTERN.finditer(text))
+        if num_predict == 0:
+            text, reason = "", 'length'
+        for pretoken in pretokens[:-1]:
+            count += pretoken_count(pretoken.group())
+            if count >= num_predict and reason is None:
+                text, reason = text[:pretoken.end()], 'length'
+    found = [index for index in (text.find(sequence) for sequence in stop) if index >= 0]
+    if found:
+        return text[:min(found)], 'stop'
+    return text, reason
+
+
+def split_at(text, positions):
+    cuts = [0] + sorted(positions) + [len(text)]
+    return [text[start:end] for start, end in zip(cuts, cuts[1:])]
+
+
+def test_stop_split_across_pieces():
+    assert limited(["Hello Us", "er", ": hi"], stop=["User:"]) == ("Hello ", 'stop')
+    assert limited(["Hello U", "nder"], stop=["User:"]) == ("Hello Under", None)
+
+
+def test_longer_stop_starting_earlier_wins():
+    assert limited(["Hi\nUser", ": there"], stop=["User", "\nUser:"]) == ("Hi", 'stop')
+    assert limited(["Hi\nUser", "s"], stop=["User", "\nUser:"]) == ("Hi\n", 'stop')
+    assert limited(["Hi\nUser"], stop=["User", "\nUser:"]) == ("Hi\n", 'stop')
+
+
+def test_num_predict_zero_and_one():
+    assert limited(["one two"], num_predict=0) == ("", 'length')
+    assert limited(["one two three"], num_predict=1) == ("one", 'length')
+
+
+def test_num_predict_cuts_inside_a_piece():
+    assert limited(["one two three four five six seven"], num_predict=3) == ("one two three", 'length')
+    text, reason = limited(["Hel", "lo wor", "ld and more"], num_predict=2)
+    assert (text, reason) == ("Hello world", 'length')
+    assert TokenCounter().take("Hello world and", 2) == ("Hello world", True)
+
+
+def test_limit_and_stop_together():
+    assert limited(["a b c STOP d"], num_predict=10, stop=["STOP"]) == ("a b c ", 'stop')
+    assert limited(["a b c ST", "OP d"], num_predict=3, stop=["STOP"]) == ("a b c", 'length')
+
+
+def test_fragmented_stream_matches_whole_text():
+    rng = random.Random(0)
+    stops = ["User", "\nUser:", "\n\n", "STOP", "ö", "12"]
+    for _ in range(500):
+        stop = rng.sample(stops, rng.randint(0, 3))
+        num_predict = rng.choice([None, 0, 1, 2, 5, 10, 30])
+        if not stop and num_predict is None:
+            continue
+        pieces = split_at(TEXT, rng.sample(range(1, len(TEXT)), rng.randint(0, 30)))
+        assert limited(pieces, stop=stop, num_predict=num_predict) == reference(TEXT, stop, num_predict), (pieces, stop, num_predict)
+
+
+def test_token_count_of_limited_text():
+    text, _ = limited([TEXT[i:i + 3] for i in range(0, len(TEXT), 3)], num_predict=12)
+    assert estimate_token_count(text) >= 12
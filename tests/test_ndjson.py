@@ -0,0 +1,69 @@
+import json
+import random
+
+from ollama_like_server import NDJSONDecoder, iter_ndjson
+
+MESSAGES = [
+    {"kind": "content", "content": "Hello"},
+    {"kind": "content", "content": " wörld — ünïcödé"},
+    {"kind": "content", "content": " 日本語のテキスト"},
+    {"kind": "content", "content": " emoji 🦙🚀"},
+    {"kind": "content", "content": "\nnew line inside\tthe content"},
+]
+
+
+def ndjson(messages):
+    return b''.join(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n' for message in messages)
+
+
+def split_at(body, positions):
+    cuts = [0] + sorted(positions) + [len(body)]
+    return [body[start:end] for start, end in zip(cuts, cuts[1:])]
+
+
+def test_random_splits_through_multibyte_characters():
+    body = ndjson(MESSAGES * 20)
+    multibyte = [index for index, byte in enumerate(body) if byte >= 0x80]
+    rng = random.Random(0)
+    for _ in range(200):
+        # Always cut inside some characters, plus anywhere else
+        positions = set(rng.sample(multibyte, 10)) | set(rng.sample(range(1, len(body)), 20))
+        assert list(iter_ndjson(split_at(body, positions))) == MESSAGES * 20
+
+
+def test_single_byte_chunks():
+    body = ndjson(MESSAGES)
+    assert list(iter_ndjson([body[i:i + 1] for i in range(len(body))])) == MESSAGES
+
+
+def test_line_split_across_many_chunks():
+    message = {"kind": "content", "content": "ä" * 5000}
+    body = ndjson([message])
+    decoder = NDJSONDecoder()
+    chunks = split_at(body, range(7, len(body), 7))
+    for chunk in chunks[:-1]:
+        assert decoder.feed(chunk) == []
+    assert decoder.feed(chunks[-1]) == [message]
+    assert decoder.close() == []
+
+
+def test_final_line_without_newline():
+    body = ndjson(MESSAGES)[:-1]
+    assert list(iter_ndjson(split_at(body, [3, len(body) - 2]))) == MESSAGES
+
+
+def test_several_lines_in_one_chunk():
+    assert list(iter_ndjson([ndjson(MESSAGES)])) == MESSAGES
+
+
+def test_invalid_lines_are_skipped():
+    body = b'{"kind": "content", "content": "a"}\nnot json\n\n   \n{"kind": "content"' + b', "content": "b"}\n{"broken": \n'
+    assert list(iter_ndjson(split_at(body, [5, 40, 41, 60]))) == [
+        {"kind": "content", "content": "a"},
+        {"kind": "content", "content": "b"},
+    ]
+
+
+def test_invalid_utf8_does_not_stop_the_stream():
+    body = b'{"kind": "content", "content": "\xff"}\n{"kind": "content", "content": "ok"}\n'
+    assert list(iter_ndjson([body]))[-1] == {"kind": "content", "content": "ok"}
@@ -0,0 +1,31 @@
+import json
+
+from ollama_like_server import Generation, ResponseFormat, estimate_prompt_tokens, estimate_token_count, format_response
+
+
+def test_list_content_counts_only_text_parts():
+    text_only = [{"role": "user", "content": "Describe this picture, please"}]
+    with_parts = [{"role": "user", "content": [
+        {"type": "text", "text": "Describe this picture,"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,iVBORw0KGgo="}},
+        {"type": "text", "text": " please"},
+    ]}]
+    assert estimate_prompt_tokens(with_parts) == estimate_prompt_tokens(text_only)
+
+
+def test_missing_and_unexpected_content_counts_as_empty():
+    empty = estimate_prompt_tokens([{"role": "user", "content": ""}])
+    assert estimate_prompt_tokens([{"role": "assistant"}]) == empty
+    assert estimate_prompt_tokens([{"role": "user", "content": None}]) == empty
+    assert estimate_prompt_tokens([{"role": "user", "content": [{"type": "text"}, "stray", 3]}]) == empty
+
+
+def test_openai_stream_with_list_content_ends_with_usage_and_done():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+    generation = Generation({"model": "llama-3.1-405b-akash-api", "messages": messages})
+    generation.complete = True
+    events = list(format_response((piece for piece in ["Hello", " there"]), generation, ResponseFormat.OPENAI_STREAM))
+    assert events[-1] == "data: [DONE]\n\n"
+    usage = json.loads(events[-2][len("data: "):])["usage"]
+    assert usage["prompt_tokens"] == estimate_prompt_tokens([{"role": "user", "content": "hi"}])
+    assert usage["completion_tokens"] == estimate_token_count("Hello there")